@@ -0,0 +1,31 @@
+import importlib.util
+import os
+import sys
+import timeit
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+
+def import_sdk():
+    """
+    Makes devtools_ai resolve to the src/ directory of this checkout, so the benchmarks measure the code next to them
+    and not an installed release.
+    """
+    if 'devtools_ai' in sys.modules:
+        return
+    spec = importlib.util.spec_from_file_location('devtools_ai', os.path.join(SRC_DIRECTORY, '__init__.py'),
+                                                  submodule_search_locations=[SRC_DIRECTORY])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['devtools_ai'] = module
+    spec.loader.exec_module(module)
+
+
+def best_time(fn, repeat=5, number=1):
+    """
+    Returns the best time of fn over repeat runs, in seconds per call.
+    """
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number
+
+
+def report(name, seconds):
+    print(f'{name:<60} {seconds * 1000:10.3f} ms')
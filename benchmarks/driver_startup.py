@@ -0,0 +1,125 @@
+"""
+Construction time of the Selenium and Appium SmartDrivers, against the screen measurement they replaced.
+
+    python benchmarks/driver_startup.py [--width 2560] [--height 1600] [--round-trip-ms 100]
+
+Both drivers wrap a stub driver serving a seeded PNG screenshot and counting its get_window_size and screenshot calls,
+with the check-in to the service stubbed out. Each driver is built with the current _measure_screen, one window size
+and one screenshot read from its PNG header, and with the previous path, where the core and then the subclass each read
+the window size and a screenshot decoded from base64 and opened with PIL. Reported: init_duration, the calls made to
+the driver, and init_duration with every call priced at --round-trip-ms, the time a real driver takes to answer.
+Exits with status 1 if the current constructors read the window size or a screenshot more than once.
+"""
+import argparse
+import base64
+import io
+import statistics
+import sys
+
+import numpy as np
+from PIL import Image
+
+from _common import import_sdk, report
+
+import_sdk()
+from devtools_ai import appium, selenium  # noqa: E402
+from devtools_ai.utils.selenium_core import SeleniumDriverCore  # noqa: E402
+
+CONSTRUCTIONS = 20
+
+
+class StubDriver:
+    """
+    The subset of a Selenium or Appium driver the SmartDriver constructors use.
+    """
+    def __init__(self, screenshot_b64, window_size):
+        self.screenshot_b64 = screenshot_b64
+        self.window_size = window_size
+        self.capabilities = {'browserName': 'chrome'}
+        self.desired_capabilities = {'platformName': 'Android', 'automationName': 'UiAutomator2'}
+        self.calls = {'get_window_size': 0, 'screenshot': 0}
+
+    def get_window_size(self):
+        self.calls['get_window_size'] += 1
+        return dict(self.window_size)
+
+    def get_screenshot_as_base64(self):
+        self.calls['screenshot'] += 1
+        return self.screenshot_b64
+
+    def quit(self):
+        pass
+
+
+class LegacyScreenMeasure:
+    """
+    The screen measurement before a single header-only read: SeleniumDriverCore and then the SmartDriver subclass each
+    read the window size and decoded a screenshot to compute the multiplier.
+    """
+    def _measure_screen(self):
+        for _ in range(2):
+            self.window_size = self.driver.get_window_size()
+            im = Image.open(io.BytesIO(base64.b64decode(self._get_screenshot())))
+            self.im_size = im.size
+            self.multiplier = 1.0 * im.size[0] / self.window_size['width']
+
+
+class LegacySeleniumSmartDriver(LegacyScreenMeasure, selenium.SmartDriver):
+    pass
+
+
+class LegacyAppiumSmartDriver(LegacyScreenMeasure, appium.SmartDriver):
+    pass
+
+
+def make_screenshot(width, height, seed=7):
+    # Noise does not compress, so the base64 string is as long as a busy page's screenshot
+    pixels = np.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, 'PNG', compress_level=1)
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def measure(name, driver_class, screenshot_b64, window_size, round_trip_ms):
+    """
+    Returns the get_window_size and screenshot calls of one construction.
+    """
+    durations = []
+    for _ in range(CONSTRUCTIONS):
+        driver = StubDriver(screenshot_b64, window_size)
+        smart_driver = driver_class(driver, 'benchmark', {'async_checkin': False})
+        durations.append(smart_driver.init_duration)
+        smart_driver.quit()
+    calls = driver.calls
+    duration = statistics.median(durations)
+    report(f'{name}, {calls["get_window_size"]} get_window_size, {calls["screenshot"]} screenshot', duration)
+    report(f'{name}, with {round_trip_ms:g} ms per driver call',
+           duration + sum(calls.values()) * round_trip_ms / 1000)
+    return calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--width', type=int, default=2560, help='Screenshot width, twice the window width')
+    parser.add_argument('--height', type=int, default=1600)
+    parser.add_argument('--round-trip-ms', type=float, default=100.0,
+                        help='Time a real driver takes per window size or screenshot call')
+    args = parser.parse_args()
+
+    # No service to check in with, the rest of the construction runs as is
+    SeleniumDriverCore._checkin = lambda self: None
+    screenshot_b64 = make_screenshot(args.width, args.height)
+    window_size = {'width': args.width // 2, 'height': args.height // 2}
+    print(f'{args.width}x{args.height} PNG screenshot, {len(screenshot_b64) / 1e6:.1f} MB of base64')
+    for name, driver_class, legacy_class in (('selenium', selenium.SmartDriver, LegacySeleniumSmartDriver),
+                                             ('appium', appium.SmartDriver, LegacyAppiumSmartDriver)):
+        calls = measure(f'{name}.SmartDriver', driver_class, screenshot_b64, window_size, args.round_trip_ms)
+        measure(f'{name}.SmartDriver, previous PIL path', legacy_class, screenshot_b64, window_size,
+                args.round_trip_ms)
+        if calls != {'get_window_size': 1, 'screenshot': 1}:
+            print(f'{name}.SmartDriver: expected one window size and one screenshot, got {calls}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Parity check and benchmark of LocalClassifier.find_best_candidate against the pairwise scan it replaced.
+
+    python benchmarks/find_best_candidate.py
+
+Every golden fixture is ranked by both implementations, which must return the same box and score or both raise
+ValueError. The fixtures are seeded: duplicate boxes, exact distance ties, boxes outside the screenshot, scores on both
+sides of the threshold and missing action infos. Exits with status 1 on the first mismatch.
+"""
+import random
+import sys
+import tempfile
+
+import numpy as np
+
+from _common import best_time, import_sdk, report
+
+import_sdk()
+from devtools_ai.utils.local_classify import LocalClassifier  # noqa: E402
+
+IMG_SHAPE = (400, 600, 3)
+THRESHOLD = 0.998
+
+
+class LegacyClassifier(LocalClassifier):
+    """
+    find_best_candidate and get_boxes_centers as they were before the vectorized ranking.
+    """
+    def get_boxes_centers(self, boxes, img_shape):
+        box_centers = []
+        for box in boxes:
+            h, w, c = img_shape
+            normalized_box = {'x': box['x'] / w, 'y': box['y'] / h, 'width': box['width'] / w,
+                              'height': box['height'] / h}
+            vec_box_center = np.array(
+                [normalized_box['x'] + normalized_box['width'] / 2, normalized_box['y'] + normalized_box['height'] / 2])
+            box_centers.append(vec_box_center)
+        return np.array(box_centers)
+
+    def find_best_candidate(self, res, img, mode='geographic', threshold=0.9999):
+        score = None
+        if res is not None:
+            oscores = res['scores']
+            oboxes = res['boxes']
+            img_shape = img.shape
+
+            scores = []
+            boxes = []
+            for score, box in zip(oscores, oboxes):
+                if self.box_in_screenshot(box, img_shape):
+                    boxes.append(box)
+                    scores.append(score)
+
+            if len(scores) > 0 and len(boxes) > 0:
+                if mode == 'geographic':
+                    cut_off = threshold
+                    geographic_scores = []
+                    geographic_boxes = []
+                    for score, box in zip(scores, boxes):
+                        if score >= cut_off:
+                            geographic_scores.append(score)
+                            geographic_boxes.append(box)
+
+                        vec_action_infos_centers = self.get_action_infos_centers(res['action_infos'])
+                        vec_box_centers = self.get_boxes_centers(geographic_boxes, img_shape)
+
+                        dists = []
+                        for idx_box in range(len(vec_box_centers)):
+                            for idx_action_info in range(len(vec_action_infos_centers)):
+                                dist = self.cdist([vec_box_centers[idx_box]], vec_action_infos_centers[idx_action_info])
+                                dists.append((idx_box, dist))
+                        amin = min(dists, key=lambda el: el[1])[0]
+                        best_geographic_box = geographic_boxes[amin]
+                        best_geographic_score = geographic_scores[amin]
+
+                        predicted_element = best_geographic_box
+                        score = best_geographic_score
+            else:
+                predicted_element = None
+                score = None
+        else:
+            predicted_element = None
+            score = None
+        return predicted_element, score
+
+
+def make_action_infos(rng, count):
+    return [{'matched_entity': {'x': rng.randint(0, 600), 'y': rng.randint(0, 400), 'width': rng.choice([10, 20]),
+                                'height': rng.choice([10, 20]), 'img_w': 600, 'img_h': 400}} for _ in range(count)]
+
+
+def make_fixture(rng):
+    count = rng.randint(1, 60)
+    boxes = [{'x': np.int64(rng.randint(-5, 590)), 'y': np.int64(rng.randint(-5, 390)),
+              'width': rng.choice([10, 20]), 'height': rng.choice([10, 20])} for _ in range(count)]
+    kind = rng.random()
+    if kind < 0.2:
+        # Every box at the same place: all distances tie
+        boxes = [dict(boxes[0]) for _ in range(count)]
+    elif kind < 0.4:
+        # Boxes mirrored around an action info center: pairs of equal distances
+        center_x, center_y = rng.randint(100, 500), rng.randint(100, 300)
+        boxes = []
+        for _ in range(count):
+            dx, dy = rng.randint(0, 90), rng.randint(0, 90)
+            boxes.append({'x': center_x + dx - 5, 'y': center_y + dy - 5, 'width': 10, 'height': 10})
+            boxes.append({'x': center_x - dx - 5, 'y': center_y - dy - 5, 'width': 10, 'height': 10})
+        action_infos = [{'matched_entity': {'x': center_x - 5, 'y': center_y - 5, 'width': 10, 'height': 10,
+                                            'img_w': 600, 'img_h': 400}}]
+        scores = [rng.choice([0.997, 0.999, 1.0]) for _ in boxes]
+        return {'boxes': boxes, 'scores': scores, 'action_infos': action_infos}
+    scores = [rng.choice([0.997, 0.998, 0.9995, 1.0]) for _ in range(count)]
+    action_infos = make_action_infos(rng, rng.choice([0, 1, 1, 2, 5]))
+    return {'boxes': boxes, 'scores': scores, 'action_infos': action_infos}
+
+
+def rank(classifier, res, img):
+    try:
+        return classifier.find_best_candidate(dict(res), img, threshold=THRESHOLD)
+    except ValueError:
+        return 'ValueError'
+
+
+def check_parity(current, legacy, img, fixtures=2000, seed=9):
+    rng = random.Random(seed)
+    outcomes = {'box': 0, 'none': 0, 'ValueError': 0}
+    cases = [{'boxes': [], 'scores': [], 'action_infos': []},
+             {'boxes': [{'x': -1, 'y': 0, 'width': 10, 'height': 10}], 'scores': [1.0], 'action_infos': []}]
+    cases += [make_fixture(rng) for _ in range(fixtures)]
+    for idx, res in enumerate(cases):
+        expected = rank(legacy, res, img)
+        actual = rank(current, res, img)
+        if actual != expected:
+            print(f'Fixture {idx} differs: expected {expected}, got {actual}')
+            sys.exit(1)
+        outcomes['ValueError' if expected == 'ValueError' else 'none' if expected[0] is None else 'box'] += 1
+    print(f'{len(cases)} golden fixtures identical: {outcomes}')
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    current = LocalClassifier('http://localhost', 'benchmark', local_cache_directory=directory)
+    legacy = LegacyClassifier('http://localhost', 'benchmark', local_cache_directory=directory)
+    img = np.zeros(IMG_SHAPE, dtype=np.uint8)
+    check_parity(current, legacy, img)
+
+    rng = random.Random(1)
+    action_infos = make_action_infos(rng, 3)
+    for count in (30, 300, 3000):
+        res = {'boxes': [{'x': rng.randint(0, 580), 'y': rng.randint(0, 380), 'width': 20, 'height': 20}
+                         for _ in range(count)],
+               'scores': [1.0] * count, 'action_infos': action_infos}
+        report(f'find_best_candidate, {count} candidates', best_time(lambda: current.find_best_candidate(
+            dict(res), img, threshold=THRESHOLD)))
+        # The pairwise scan is quadratic in the candidates times the action infos, 3000 takes over a minute
+        if count <= 300:
+            report(f'previous pairwise scan, {count} candidates', best_time(lambda: legacy.find_best_candidate(
+                dict(res), img, threshold=THRESHOLD), repeat=3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark of the Scanner LinkManager frontier against the list-based one it replaced, on a synthetic link graph.
+
+    python benchmarks/link_manager.py [--nodes 100000] [--out-links 10]
+
+The graph is seeded: every page links to the next one, so the whole graph is reachable, and to out-links - 1 random
+pages. It is crawled breadth first the way Scanner.crawl_domain drives its link manager: get_link, visited_link, then
+add_link for every out-link. On the graphs small enough for the list-based frontier, both must visit the pages in the
+same order with the same referrers and depths. Exits with status 1 otherwise.
+"""
+import argparse
+import random
+import sys
+import time
+
+from _common import import_sdk, report
+
+import_sdk()
+from devtools_ai.utils.scanner import LinkManager  # noqa: E402
+
+# Past this many pages the list-based frontier takes minutes, its membership tests being linear
+LEGACY_MAX_NODES = 5000
+
+
+class LegacyLinkManager:
+    """
+    LinkManager as it was before the deque and hash sets.
+    """
+    def __init__(self):
+        self.links_visited = []
+        self.links_to_visit = []
+        self.referrers = []
+        self.depths = []
+
+    def add_link(self, referrer, link, depth=0):
+        if not self.seen(link) and not link in self.links_to_visit:
+            self.links_to_visit.append(link)
+            self.referrers.append(referrer)
+            self.depths.append(depth)
+
+    def get_link(self):
+        return self.referrers.pop(0), self.links_to_visit.pop(0), self.depths.pop(0)
+
+    def visited_link(self, link):
+        self.links_visited.append(link)
+
+    def visited_count(self):
+        return len(self.links_visited)
+
+    def has_more_links(self):
+        return len(self.links_to_visit) > 0
+
+    def seen(self, link):
+        return link in self.links_visited
+
+
+def make_graph(nodes, out_links, seed=5):
+    rng = random.Random(seed)
+    urls = [f'https://example.com/page/{idx}' for idx in range(nodes)]
+    graph = {}
+    for idx, url in enumerate(urls):
+        graph[url] = [urls[(idx + 1) % nodes]] + [urls[rng.randrange(nodes)] for _ in range(out_links - 1)]
+    return urls[0], graph
+
+
+def crawl(link_manager, start, graph):
+    """
+    Returns the (referrer, link, depth) records in visit order.
+    """
+    visits = []
+    link_manager.add_link(start, start, depth=0)
+    while link_manager.has_more_links():
+        referrer, link, depth = link_manager.get_link()
+        visits.append((referrer, link, depth))
+        link_manager.visited_link(link)
+        for out_link in graph[link]:
+            link_manager.add_link(link, out_link, depth + 1)
+    return visits
+
+
+def timed_crawl(link_manager, start, graph):
+    started = time.perf_counter()
+    visits = crawl(link_manager, start, graph)
+    return visits, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--out-links', type=int, default=10)
+    args = parser.parse_args()
+
+    for nodes in sorted({1000, LEGACY_MAX_NODES, args.nodes}):
+        start, graph = make_graph(nodes, args.out_links)
+        visits, seconds = timed_crawl(LinkManager(), start, graph)
+        if len(visits) != nodes:
+            print(f'{nodes} pages: the crawl visited {len(visits)} pages')
+            sys.exit(1)
+        report(f'LinkManager, {nodes} pages, {nodes * args.out_links} links', seconds)
+        if nodes <= LEGACY_MAX_NODES:
+            legacy_visits, legacy_seconds = timed_crawl(LegacyLinkManager(), start, graph)
+            if legacy_visits != visits:
+                print(f'{nodes} pages: the crawl order differs from the list-based frontier')
+                sys.exit(1)
+            report(f'list-based frontier, {nodes} pages, {nodes * args.out_links} links', legacy_seconds)
+            print(f'{nodes} pages: same crawl order as the list-based frontier')
+
+
+if __name__ == '__main__':
+    main()
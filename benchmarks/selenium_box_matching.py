@@ -0,0 +1,192 @@
+"""
+Parity check and benchmark of SmartDriver._match_box_to_page_rects against the per element _match_box_to_elements.
+
+    python benchmarks/selenium_box_matching.py
+
+Both matchers run against an in-memory page, a fake driver that serves find_elements, element.rect and the
+PAGE_RECTS_SCRIPT snapshot from the same seeded elements and counts the WebDriver calls made. The check first compares
+_iou_boxes_array and _center_hit_array with _iou_boxes and _center_hit on random rects, then requires both matchers to
+pick the same element for random boxes. Rects include duplicates, nested rects sharing an edge, rects the box center
+lies exactly on the edge of, and empty rects. Exits with status 1 on the first mismatch.
+
+The timings only cover the Python side, each WebDriver call being a round trip to the browser that the report prices
+at --round-trip-ms.
+"""
+import argparse
+import random
+import sys
+
+import numpy as np
+from selenium.webdriver.common.by import By
+
+from _common import best_time, import_sdk, report
+
+import_sdk()
+from devtools_ai.selenium import PAGE_RECTS_SCRIPT, NoElementFoundException, SmartDriver  # noqa: E402
+
+ELEMENT_TYPES = ['a', 'input', 'button', 'img', '*']
+TAGS = ['div', 'span', 'a', 'input', 'button', 'img', 'p', 'li']
+
+
+class FakeElement:
+    def __init__(self, page, tag_name, rect):
+        self.page = page
+        self.tag_name = tag_name
+        self._rect = rect
+
+    @property
+    def rect(self):
+        self.page.calls += 1
+        return dict(self._rect)
+
+
+class FakePage:
+    """
+    The subset of a WebDriver both matchers use, over a fixed list of elements in document order.
+    """
+    def __init__(self, rects_and_tags):
+        self.calls = 0
+        self.elements = [FakeElement(self, tag_name, rect) for tag_name, rect in rects_and_tags]
+        # Answers computed once, the browser side work is not what is measured
+        self.by_tag = {'*': self.elements}
+        for element in self.elements:
+            self.by_tag.setdefault(element.tag_name, []).append(element)
+        self.rects = [[e._rect['x'], e._rect['y'], e._rect['width'], e._rect['height']] for e in self.elements]
+        self.indices = {}
+        for idx, element in enumerate(self.elements):
+            self.indices.setdefault(element.tag_name, []).append(idx)
+
+    def find_elements(self, by, xpath):
+        assert by == By.XPATH and xpath.startswith('//')
+        self.calls += 1
+        return list(self.by_tag.get(xpath[2:], []))
+
+    def execute_script(self, script, *args):
+        self.calls += 1
+        if script == PAGE_RECTS_SCRIPT:
+            return {'rects': self.rects, 'groups': [self.indices.get(xpath[2:], []) for xpath in args[0]]}
+        if 'window.__devtoolsAiElements' in script:
+            return self.elements[args[0]]
+        raise ValueError(f'Unexpected script {script!r}')
+
+
+def make_smart_driver(page):
+    # Only the matching helpers are used, which need nothing but the driver
+    smart_driver = SmartDriver.__new__(SmartDriver)
+    smart_driver.driver = page
+    return smart_driver
+
+
+def random_rect(rng, integer):
+    if integer:
+        return {'x': rng.randint(0, 1200), 'y': rng.randint(0, 3000), 'width': rng.randint(0, 400),
+                'height': rng.randint(0, 120)}
+    return {'x': rng.uniform(0, 1200), 'y': rng.uniform(0, 3000), 'width': rng.uniform(0, 400),
+            'height': rng.uniform(0, 120)}
+
+
+def make_page(rng, count, integer=True):
+    rects_and_tags = []
+    while len(rects_and_tags) < count:
+        rect = random_rect(rng, integer)
+        kind = rng.random()
+        rects_and_tags.append((rng.choice(TAGS), rect))
+        if kind < 0.2:
+            # A wrapper with the same rect as its child: an exact IoU tie, document order decides
+            rects_and_tags.append((rng.choice(TAGS), dict(rect)))
+        elif kind < 0.3:
+            # A child sharing the top left corner, and an empty element
+            rects_and_tags.append((rng.choice(TAGS), dict(rect, width=rect['width'] / 2, height=rect['height'])))
+            rects_and_tags.append((rng.choice(TAGS), dict(rect, width=0, height=0)))
+    return rects_and_tags[:count]
+
+
+def make_box(rng, rects_and_tags):
+    _, rect = rng.choice(rects_and_tags)
+    kind = rng.random()
+    if kind < 0.4:
+        # The element itself, or a box around it
+        jitter = rng.choice([0, 0, 1, 3])
+        return {'x': rect['x'] - jitter, 'y': rect['y'] - jitter, 'width': max(1, rect['width'] + 2 * jitter),
+                'height': max(1, rect['height'] + 2 * jitter)}
+    if kind < 0.5:
+        # A box whose center lies exactly on the left edge of the element
+        return {'x': rect['x'] - 10, 'y': rect['y'], 'width': 20, 'height': max(1, rect['height'])}
+    box = random_rect(rng, kind < 0.75)
+    box['width'] = max(1, box['width'])
+    box['height'] = max(1, box['height'])
+    return box
+
+
+def match(smart_driver, method, box):
+    try:
+        element = getattr(smart_driver, method)(box, ELEMENT_TYPES)
+    except NoElementFoundException:
+        return None
+    return smart_driver.driver.elements.index(element)
+
+
+def check_helpers(smart_driver, rng, count=20000):
+    for integer in (True, False):
+        rects = [random_rect(rng, integer) for _ in range(count)]
+        # Ties with the box itself, and rects the box center lies on the edge of
+        box = {'x': 100, 'y': 100, 'width': 40, 'height': 20}
+        rects += [dict(box), {'x': 120, 'y': 90, 'width': 10, 'height': 40}, {'x': 80, 'y': 110, 'width': 40, 'height': 5}]
+        for box in [box] + [random_rect(rng, integer) for _ in range(20)]:
+            box['width'] = max(1, box['width'])
+            box['height'] = max(1, box['height'])
+            array = np.array([[r['x'], r['y'], r['width'], r['height']] for r in rects])
+            iou = smart_driver._iou_boxes_array(box, array)
+            hits = smart_driver._center_hit_array(box, array)
+            for idx, rect in enumerate(rects):
+                if iou[idx] != smart_driver._iou_boxes(box, rect) or hits[idx] != smart_driver._center_hit(box, rect):
+                    print(f'Helpers differ for box {box} and rect {rect}: {iou[idx]} / {hits[idx]}, '
+                          f'{smart_driver._iou_boxes(box, rect)} / {smart_driver._center_hit(box, rect)}')
+                    sys.exit(1)
+    print(f'_iou_boxes_array and _center_hit_array identical on {2 * 21 * (count + 3)} box and rect pairs')
+
+
+def check_selection(rng, pages=50, boxes=200):
+    found = total = 0
+    for page_idx in range(pages):
+        page = FakePage(make_page(rng, rng.randint(1, 400), integer=page_idx % 2 == 0))
+        smart_driver = make_smart_driver(page)
+        for _ in range(boxes):
+            box = make_box(rng, [(e.tag_name, e._rect) for e in page.elements])
+            expected = match(smart_driver, '_match_box_to_elements', box)
+            actual = match(smart_driver, '_match_box_to_page_rects', box)
+            if actual != expected:
+                print(f'Page {page_idx}, box {box}: per element matching picked {expected}, page rects {actual}')
+                sys.exit(1)
+            found += expected is not None
+            total += 1
+    print(f'Both matchers pick the same element for {total} boxes, {found} of them matching an element')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--round-trip-ms', type=float, default=1.0, help='Cost of one WebDriver call in the report')
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    check_helpers(make_smart_driver(FakePage([])), rng)
+    check_selection(rng)
+
+    for count in (200, 2000, 10000):
+        page = FakePage(make_page(rng, count))
+        smart_driver = make_smart_driver(page)
+        # A box only matched by the last "*" group, so the per element matching goes through every group
+        box = next(dict(e._rect) for e in page.elements if e._rect['width'] > 2 and e._rect['height'] > 2 and
+                   page.elements[match(smart_driver, '_match_box_to_page_rects', e._rect)].tag_name not in ELEMENT_TYPES)
+        for method in ('_match_box_to_elements', '_match_box_to_page_rects'):
+            page.calls = 0
+            match(smart_driver, method, box)
+            calls = page.calls
+            seconds = best_time(lambda: getattr(smart_driver, method)(box, ELEMENT_TYPES), repeat=3)
+            report(f'{method}, {count} elements, {calls} calls', seconds)
+            report(f'{method}, {count} elements, with {args.round_trip_ms:g} ms per call',
+                   seconds + calls * args.round_trip_ms / 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Accuracy and latency of the coarse-to-fine pyramid search against the full-resolution search, on synthetic screenshots.
+
+    python benchmarks/template_match_pyramid.py [--screenshots 10] [--scales 0.25 0.5]
+
+Every screenshot is a seeded clutter of labelled buttons. On top of it are a few buttons with a unique label and
+eight identical ones, whose template matches several places. Their crops are the templates, each matched with
+template_match_core_multi and with template_match_core_pyramid. Reported per resolution:
+ - found: for a unique button, whether its location is among the boxes over template_match_threshold; for the
+   identical ones, how many of the eight locations are
+ - same boxes: the pyramid returns the same boxes over template_match_threshold as the full search, with the same
+   scores up to rounding
+ - the mean time per template of each search, and of the one downscale per screenshot the pyramid needs
+Exits with status 1 if the pyramid search finds fewer unique buttons than the full search.
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from _common import import_sdk, report
+
+import_sdk()
+from devtools_ai.utils.local_classify import LocalClassifier  # noqa: E402
+
+RESOLUTIONS = ((1920, 1080), (3840, 2160))
+UNIQUE_TEMPLATES_PER_SCREENSHOT = 2
+
+
+def draw_button(img, x, y, w, h, color, label):
+    cv2.rectangle(img, (x, y), (x + w, y + h), color, -1)
+    cv2.rectangle(img, (x, y), (x + w, y + h), (60, 60, 60), 1)
+    cv2.putText(img, label, (x + 6, y + h - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+
+
+def make_screenshot(rng, width, height):
+    """
+    Returns the screenshot, the boxes of buttons with a unique label and the boxes of identical buttons.
+    """
+    img = np.full((height, width, 3), 240, dtype=np.uint8)
+    for _ in range(width * height // 20000):
+        x, y = int(rng.integers(0, width - 200)), int(rng.integers(0, height - 80))
+        w, h = int(rng.integers(40, 200)), int(rng.integers(20, 80))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        draw_button(img, x, y, w, h, color, f'btn{int(rng.integers(1000))}')
+    # Buttons drawn last are fully visible and make the templates, the identical ones match several places
+    unique_boxes = []
+    for idx in range(UNIQUE_TEMPLATES_PER_SCREENSHOT):
+        x, y = int(rng.integers(0, width - 200)), int(rng.integers(0, height - 60))
+        w, h = int(rng.integers(80, 200)), int(rng.integers(30, 60))
+        draw_button(img, x, y, w, h, tuple(int(c) for c in rng.integers(100, 255, 3)), f'Element {idx}')
+        unique_boxes.append((x, y, w + 1, h + 1))
+    repeated_boxes = []
+    for _ in range(8):
+        x, y = int(rng.integers(0, width - 100)), int(rng.integers(0, height - 40))
+        draw_button(img, x, y, 90, 30, (200, 160, 40), 'Submit')
+        repeated_boxes.append((x, y, 91, 31))
+    return img, unique_boxes, repeated_boxes
+
+
+def over_threshold(classifier, boxes, scores):
+    return [(int(box['x']), int(box['y']), float(score))
+            for box, score in zip(boxes, scores) if score > classifier.template_match_threshold]
+
+
+def same_boxes(expected, actual):
+    # Scores of a window and of the whole screenshot differ by the float32 rounding of matchTemplate
+    return [(x, y) for x, y, _ in expected] == [(x, y) for x, y, _ in actual] and \
+        all(abs(a - b) < 1e-5 for (_, _, a), (_, _, b) in zip(expected, actual))
+
+
+def run(full, pyramids, rng, width, height, screenshots):
+    unique = {'total': 0, 'full': 0, **{scale: {'agreed': 0, 'found': 0} for scale in pyramids}}
+    repeated = {'total': 0, 'full': 0, **{scale: {'agreed': 0, 'found': 0} for scale in pyramids}}
+    timings = {'full': 0.0, **{scale: 0.0 for scale in pyramids}}
+    downscale_timings = {scale: 0.0 for scale in pyramids}
+    for _ in range(screenshots):
+        img, unique_boxes, repeated_boxes = make_screenshot(rng, width, height)
+        small_imgs = {}
+        for scale, pyramid in pyramids.items():
+            start = time.perf_counter()
+            small_imgs[scale] = pyramid.downscale_gray(img)
+            downscale_timings[scale] += time.perf_counter() - start
+        repeated_locations = {(x, y) for x, y, _, _ in repeated_boxes}
+        # The last identical button is not covered by another one
+        templates = [(unique, x, y, w, h) for x, y, w, h in unique_boxes] + [(repeated, *repeated_boxes[-1])]
+        for stats, x, y, w, h in templates:
+            template = img[y:y + h, x:x + w].copy()
+            start = time.perf_counter()
+            expected = over_threshold(full, *full.template_match_core_multi(img, template))
+            timings['full'] += time.perf_counter() - start
+            stats['total'] += 1
+            # For a unique button: whether its own location is found, for identical ones: how many of them are found
+            locations = {(x, y)} if stats is unique else repeated_locations
+            stats['full'] += len(locations & {(bx, by) for bx, by, _ in expected})
+            for scale, pyramid in pyramids.items():
+                start = time.perf_counter()
+                actual = over_threshold(pyramid, *pyramid.template_match_core_pyramid(img, template, small_imgs[scale]))
+                timings[scale] += time.perf_counter() - start
+                stats[scale]['agreed'] += same_boxes(expected, actual)
+                stats[scale]['found'] += len(locations & {(bx, by) for bx, by, _ in actual})
+
+    print(f'{width}x{height}, {unique["total"]} unique buttons: found by the full search {unique["full"]}')
+    for scale in pyramids:
+        print(f'  pyramid_scale {scale}: found {unique[scale]["found"]}, same boxes as the full search '
+              f'{unique[scale]["agreed"]}')
+    print(f'{width}x{height}, {repeated["total"]} identical buttons: copies found by the full search {repeated["full"]}')
+    for scale in pyramids:
+        print(f'  pyramid_scale {scale}: copies found {repeated[scale]["found"]}, same boxes as the full search '
+              f'{repeated[scale]["agreed"]}')
+    total = unique['total'] + repeated['total']
+    missed = [scale for scale in pyramids if unique[scale]['found'] < unique['full']]
+    report(f'{width}x{height} full search, per template', timings['full'] / total)
+    for scale in pyramids:
+        report(f'{width}x{height} pyramid_scale {scale}, per template', timings[scale] / total)
+        report(f'{width}x{height} pyramid_scale {scale} downscale, per screenshot',
+               downscale_timings[scale] / screenshots)
+    if missed:
+        print(f'{width}x{height}: the pyramid search finds fewer unique buttons than the full search with '
+              f'pyramid_scale {missed}')
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--screenshots', type=int, default=10, help='Screenshots per resolution')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.25, 0.5], help='pyramid_scale values to compare')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    full = LocalClassifier('http://localhost', 'benchmark', local_cache_directory=tempfile.mkdtemp())
+    pyramids = {scale: LocalClassifier('http://localhost', 'benchmark', local_cache_directory=tempfile.mkdtemp(),
+                                       pyramid_scale=scale) for scale in args.scales}
+    rng = np.random.default_rng(args.seed)
+    for width, height in RESOLUTIONS:
+        run(full, pyramids, rng, width, height, args.screenshots)
+
+
+if __name__ == '__main__':
+    main()
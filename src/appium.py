@@ -1,16 +1,16 @@
-import base64
-import io
 import logging
+import re
 import requests
 import requests.packages.urllib3
 import time
 import urllib.parse
 import uuid
 import webbrowser
+import numpy as np
+import xml.etree.ElementTree as ET
 
 from appium import webdriver
 from distutils.util import strtobool
-from PIL import Image
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.common.exceptions import StaleElementReferenceException
 
@@ -21,6 +21,10 @@ requests.packages.urllib3.disable_warnings()
 
 log = logging.getLogger(__name__)
 
+INTERACTABLE_ELEMENTS = ["input", "edittext", "edit", "select", "dropdown", "button", "textfield", "textarea", "picker", "spinner"]
+NON_INTERACTABLE_ELEMENTS = ["layout"]
+BOUNDS_PATTERN = re.compile(r'\[(-?[\d.]+),(-?[\d.]+)\]\[(-?[\d.]+),(-?[\d.]+)\]')
+
 
 class SmartDriver(SeleniumDriverCore):
     def __init__(self, driver, api_key, initialization_dict={}):
@@ -33,13 +37,10 @@ class SmartDriver(SeleniumDriverCore):
         self._driver_type = 'appium'
         SeleniumDriverCore.__init__(self, driver, api_key, initialization_dict)
         self._driver_type = 'appium'
-        window_size = self.driver.get_window_size()
-        screenshotBase64 = self._get_screenshot()
-        im = Image.open(io.BytesIO(base64.b64decode(screenshotBase64)))
-        width, height = im.size
-        self.multiplier = max(1.0, 1.0 * width / window_size['width'])
+        self.multiplier = max(1.0, self.multiplier)
         self.is_espresso = self.automation_name.lower() == 'espresso'
         self.is_ios = self.automation_name.lower() == 'xcuitest'
+        self._init_done()
 
 
     def implicitly_wait(self, wait_time):
@@ -145,7 +146,77 @@ class SmartDriver(SeleniumDriverCore):
         multiplier = max(1, multiplier)
         new_box = {'x': bounding_box['x'] / multiplier, 'y': bounding_box['y'] / multiplier,
                    'width': bounding_box['width'] / multiplier, 'height': bounding_box['height'] / multiplier}
-
+        if self.use_vectorized_matching:
+            try:
+                return self._match_box_to_page_source(new_box)
+            except NoElementFoundException:
+                raise
+            except Exception as e:
+                log.debug(f'Page source element matching failed, falling back to per element matching: {e}')
+        return self._match_box_to_elements(new_box)
+
+    def _parse_page_source(self):
+        """
+            Parses the page source once and returns, in document order (same as //*), the absolute xpath, tag, class and
+            rect of every node. UiAutomator2 and Espresso give bounds="[x1,y1][x2,y2]", XCUITest gives x, y, width, height.
+        """
+        root = ET.fromstring(self.driver.page_source)
+        class_attribute = 'type' if self.is_ios else 'class'
+        xpaths, tags, classes, rects = [], [], [], []
+        stack = [(root, '/' + root.tag)]
+        while stack:
+            node, xpath = stack.pop()
+            attributes = node.attrib
+            xpaths.append(xpath)
+            tags.append(node.tag)
+            classes.append(attributes.get(class_attribute, node.tag).lower())
+            bounds = BOUNDS_PATTERN.match(attributes.get('bounds', ''))
+            if bounds is not None:
+                x1, y1, x2, y2 = [float(v) for v in bounds.groups()]
+                rects.append((x1, y1, x2 - x1, y2 - y1))
+            else:
+                rects.append(tuple(float(attributes.get(k, 0) or 0) for k in ('x', 'y', 'width', 'height')))
+            positions = {}
+            children = []
+            for child in node:
+                positions[child.tag] = positions.get(child.tag, 0) + 1
+                children.append((child, f'{xpath}/{child.tag}[{positions[child.tag]}]'))
+            stack.extend(reversed(children))
+        return xpaths, tags, classes, np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+
+    def _match_box_to_page_source(self, new_box):
+        """
+            Same selection as _match_box_to_elements, scored in memory from a single page source fetch.
+            Only the winning node is looked up on the device.
+        """
+        xpaths, tags, classes, rects = self._parse_page_source()
+        if len(xpaths) == 0:
+            raise NoElementFoundException('Could not find any web element under the center of the bounding box')
+        iou_scores = self._iou_boxes_array(new_box, rects)
+        # stable sort on the negated scores keeps document order on ties, like sorted(..., reverse=True)
+        order = np.argsort(-iou_scores, kind='stable')
+        hits = (iou_scores > 0) & self._center_hit_array(new_box, rects)
+        composite = order[hits[order]]
+
+        best = None
+        if len(composite) > 0:
+            top_score = iou_scores[composite[0]]
+            for idx in composite:
+                if iou_scores[idx] > 0.6 * top_score and any(c in classes[idx] for c in INTERACTABLE_ELEMENTS) and \
+                        not any(c in classes[idx] for c in NON_INTERACTABLE_ELEMENTS):
+                    best = idx
+                    break
+        if best is None:
+            if iou_scores[order[0]] < 0.25:
+                raise NoElementFoundException('Could not find any web element under the center of the bounding box')
+            best = order[0]
+            for idx in composite:
+                if tags[idx] == 'input' or tags[idx] == 'button':
+                    best = idx
+                    break
+        return self.driver.find_element(by='xpath', value=xpaths[int(best)])
+
+    def _match_box_to_elements(self, new_box):
         # Get all elements
         try:
             elements = self.driver.find_elements(by='xpath', value='//*')
@@ -173,8 +244,8 @@ class SmartDriver(SeleniumDriverCore):
         elif self.is_ios:
             attribute_for_class = "type"
 
-        interactable_elements = ["input", "edittext", "edit", "select", "dropdown", "button", "textfield", "textarea", "picker", "spinner"]
-        non_interactable_elements = ["layout"]
+        interactable_elements = INTERACTABLE_ELEMENTS
+        non_interactable_elements = NON_INTERACTABLE_ELEMENTS
 
         for score, element in composite:
             for interactable_class in interactable_elements:
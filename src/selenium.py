@@ -1,4 +1,3 @@
-import base64
 import json
 import logging
 import requests
@@ -9,9 +8,8 @@ import warnings
 import webbrowser
 
 
-import io
+import numpy as np
 from distutils.util import strtobool
-from PIL import Image
 from packaging import version
 from time import sleep
 
@@ -37,29 +35,60 @@ requests.packages.urllib3.disable_warnings()
 
 log = logging.getLogger(__name__)
 
+# Snapshots every element of the page in document order along with its rect (in document coordinates, like element.rect)
+# and, for each xpath passed in, the indices of the elements it matches. The snapshot is kept on the window so the
+# winning element can be fetched by index afterwards.
+PAGE_RECTS_SCRIPT = """
+var all = document.evaluate('//*', document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+var elements = [], rects = [], indices = new Map();
+var sx = window.pageXOffset, sy = window.pageYOffset;
+for (var i = 0; i < all.snapshotLength; i++) {
+    var el = all.snapshotItem(i);
+    var r = el.getBoundingClientRect();
+    elements.push(el);
+    indices.set(el, i);
+    rects.push([r.left + sx, r.top + sy, r.width, r.height]);
+}
+var groups = [];
+for (var j = 0; j < arguments[0].length; j++) {
+    var matches = document.evaluate(arguments[0][j], document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    var group = [];
+    for (var k = 0; k < matches.snapshotLength; k++) {
+        var idx = indices.get(matches.snapshotItem(k));
+        if (idx !== undefined) {
+            group.push(idx);
+        }
+    }
+    groups.push(group);
+}
+window.__devtoolsAiElements = elements;
+return {'rects': rects, 'groups': groups};
+"""
+
 class SmartDriver(SeleniumDriverCore):
     def __init__(self, driver, api_key=None, initialization_dict={}):
         self.version = 'selenium-' + base_version
         self.automation_name = driver.capabilities.get('browserName', '')
         SeleniumDriverCore.__init__(self, driver, api_key, initialization_dict)
-        window_size = self.driver.get_window_size()
-        self.window_size = window_size
-        screenshotBase64 = self._get_screenshot()
         self._driver_type = 'selenium'
-        im = Image.open(io.BytesIO(base64.b64decode(screenshotBase64)))
-        width, height = im.size
-        self.im_size = im.size
-        self.multiplier = 1.0 * width / window_size['width']
-        self_attrs = dir(self)
         # Disable warnings
         requests.packages.urllib3.disable_warnings()
-        self.local_classify = None
         if self.do_local_caching:
-            self.local_classify = LocalClassifier(self.url, self.api_key, template_match_threshold=self.local_match_threshold)
-            for element_name in self.element_names_in_tc:
-                self.local_classify.cache_templates_for_element(element_name)
+            self.local_classify = LocalClassifier(self.url, self.api_key, template_match_threshold=self.local_match_threshold,
+                                                session=self.http_session,
+                                                template_cache_bytes=self.local_template_cache_mb * 1024 * 1024,
+                                                workers=self.local_match_workers,
+                                                pyramid_scale=self.local_match_pyramid_scale,
+                                                roi_search=self.local_match_roi_search,
+                                                nms_iou=self.local_match_nms_iou,
+                                                nms_max_candidates=self.local_match_max_candidates,
+                                                prefetch_workers=self.local_prefetch_workers,
+                                                prefetch_timeout=self.local_prefetch_timeout,
+                                                download_workers=self.local_download_workers)
+            self._after_checkin(self.local_classify.prefetch)
 
         warnings.filterwarnings("ignore", category=DeprecationWarning)
+        self._init_done()
 
     def _get_elem(self, screenshotBase64, element_name, offset):
         for i in range(1):
@@ -68,7 +97,7 @@ class SmartDriver(SeleniumDriverCore):
                     "b64": screenshotBase64,
                     "use_gclf":  True
                 }
-                r = requests.post(url='http://kirfuzz.dev-tools.ai:5002/classify', json=data, timeout=100)
+                r = self.http_session.post(url='http://kirfuzz.dev-tools.ai:5002/classify', json=data, timeout=100)
                 raw_content = r.content
                 elems = json.loads(raw_content)
                 for e in elems:
@@ -158,6 +187,7 @@ class SmartDriver(SeleniumDriverCore):
                 screenshotBase64 = self._get_screenshot()
                 self.last_test_case_screenshot_uuid = self.get_screenshot_hash(screenshotBase64)
 
+                self._wait_for_checkin(self.misc_timeout)
                 element_box = self.local_classify.classify_element(element_name, screenshotBase64)
                 if element_box is not None:
                     msg = 'Found using local cache'
@@ -210,6 +240,7 @@ class SmartDriver(SeleniumDriverCore):
             key = self.get_screenshot_hash(screenshotBase64)
 
             if self.do_local_caching:
+                self._wait_for_checkin(self.misc_timeout)
                 local_pred = self.local_classify.classify_element(element_name, screenshotBase64)
                 if local_pred is not None:
                     msg = 'Found using local cache'
@@ -354,6 +385,43 @@ class SmartDriver(SeleniumDriverCore):
                    'width': bounding_box['width'] / multiplier, 'height': bounding_box['height'] / multiplier}
         new_box['y'] += offset
         element_types = ["a", "input", "button", "img",  "*"]
+        if self.use_vectorized_matching:
+            try:
+                return self._match_box_to_page_rects(new_box, element_types)
+            except NoElementFoundException:
+                raise
+            except Exception as e:
+                log.debug(f'Vectorized element matching failed, falling back to per element matching: {e}')
+        return self._match_box_to_elements(new_box, element_types)
+
+    def _match_box_to_page_rects(self, new_box, element_types):
+        """
+            Same selection as _match_box_to_elements, but all the rects are fetched with a single script and scored with numpy,
+            only the winning element is then sent back over the wire.
+        """
+        xpaths = ["//" + element_type for element_type in element_types if element_type != "*"]
+        page = self.driver.execute_script(PAGE_RECTS_SCRIPT, xpaths)
+        rects = np.asarray(page['rects'], dtype=np.float64).reshape(-1, 4)
+        iou_scores = self._iou_boxes_array(new_box, rects)
+        hits = (iou_scores > 0.2) & self._center_hit_array(new_box, rects)
+        groups = iter(page['groups'])
+        for element_type in element_types:
+            if element_type == "*":
+                indices = np.arange(len(rects))
+            else:
+                indices = np.asarray(next(groups), dtype=np.int64)
+            indices = indices[hits[indices]]
+            if len(indices) == 0:
+                continue
+            # argmax keeps the first maximum, i.e. document order on ties like the stable sort of the per element matching
+            best = int(indices[np.argmax(iou_scores[indices])])
+            element = self.driver.execute_script('return window.__devtoolsAiElements[arguments[0]];', best)
+            if element is None:
+                raise StaleElementReferenceException('Page changed while matching the bounding box')
+            return element
+        raise NoElementFoundException('Could not find any web element under the center of the bounding box')
+
+    def _match_box_to_elements(self, new_box, element_types):
         for element_type in element_types:
             # Get all elements
             try:
@@ -0,0 +1,127 @@
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class BackgroundTaskQueue:
+    """
+    Bounded queue of callables executed by daemon worker threads.
+    :Args:
+     - max_size: Maximum number of tasks waiting to be run.
+     - workers: Number of worker threads.
+     - drop_policy: What to do when the queue is full:
+        'block' waits up to block_timeout seconds for a free slot (backpressure) and then drops the new task,
+        'drop_newest' drops the new task right away,
+        'drop_oldest' drops the oldest waiting task to make room for the new one.
+     - block_timeout: Maximum time to wait for a free slot with the 'block' policy, None waits forever.
+    """
+    DROP_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, max_size=16, workers=1, drop_policy='block', block_timeout=None, name='devtools-ai-worker'):
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError(f'Unknown drop policy {drop_policy}, expected one of {self.DROP_POLICIES}')
+        self.drop_policy = drop_policy
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._threads = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._run, name=f'{name}-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs). Returns False if the task was dropped.
+        """
+        if self._closed:
+            log.debug('Task queue closed, dropping task')
+            self._count('dropped')
+            return False
+        task = (fn, args, kwargs)
+        try:
+            if self.drop_policy == 'block':
+                self._queue.put(task, timeout=self.block_timeout)
+            elif self.drop_policy == 'drop_newest':
+                self._queue.put_nowait(task)
+            else:
+                while True:
+                    try:
+                        self._queue.put_nowait(task)
+                        break
+                    except queue.Full:
+                        try:
+                            self._queue.get_nowait()
+                            self._queue.task_done()
+                            self._count('dropped')
+                            log.debug('Task queue full, dropped oldest task')
+                        except queue.Empty:
+                            pass
+        except queue.Full:
+            log.debug('Task queue full, dropped new task')
+            self._count('dropped')
+            return False
+        self._count('submitted')
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued task has run. Returns False if the timeout expired first.
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Flushes the queue and stops the workers.
+        """
+        flushed = self.flush(timeout)
+        self._closed = True
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        return flushed
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def stats(self):
+        with self._lock:
+            return {'submitted': self.submitted, 'completed': self.completed, 'failed': self.failed,
+                    'dropped': self.dropped, 'pending': self.pending()}
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                fn, args, kwargs = task
+                try:
+                    fn(*args, **kwargs)
+                    self._count('completed')
+                except Exception as e:
+                    log.exception(e)
+                    self._count('failed')
+            finally:
+                self._queue.task_done()
@@ -6,20 +6,93 @@ import logging
 import glob
 import json
 import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+from devtools_ai.utils.background import BackgroundTaskQueue
 from devtools_ai.utils.network_utils import NetworkUtils
+from devtools_ai.utils.template_store import ElementIndex, TemplateStore
 
 log = logging.getLogger(__name__)
 
 # Converts a b64 image to a cv2 image
 def b642cv2(b64img):
     img_bytes = base64.b64decode(b64img)
-    np_arr = np.fromstring(img_bytes, np.uint8)
+    np_arr = np.frombuffer(img_bytes, np.uint8)
     cv_img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
     return cv_img
 
+
+class TemplateCache:
+    """
+    Thread-safe LRU of decoded templates keyed by template uuid, bounded by the total bytes of the decoded images.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, template_uuid):
+        with self._lock:
+            template = self._templates.get(template_uuid)
+            if template is None:
+                self.misses += 1
+                return None
+            self._templates.move_to_end(template_uuid)
+            self.hits += 1
+            return template
+
+    def put(self, template_uuid, template):
+        if template is None or template.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._templates.pop(template_uuid, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes
+            self._templates[template_uuid] = template
+            self.current_bytes += template.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._templates.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.current_bytes > self.max_bytes and self._templates:
+                _, evicted = self._templates.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._templates), 'bytes': self.current_bytes, 'max_bytes': self.max_bytes}
+
+
+# Shared by every LocalClassifier of the process
+template_cache = TemplateCache()
+
 class LocalClassifier:
-    def __init__(self, url, api_key, local_cache_directory=None, template_match_threshold=0.998):
+    # matchTemplate accumulates in float32: copies of an exact match score between 0 and a few 1e-7 depending on where
+    # they are, and on the size of the searched image. Hits that close to the best one are all kept.
+    MATCH_ROUNDING = 1e-6
+
+    def __init__(self, url, api_key, local_cache_directory=None, template_match_threshold=0.998, session=None,
+                 template_cache_bytes=None, workers=1, pyramid_scale=None, pyramid_coarse_threshold=0.01,
+                 pyramid_max_candidates=64, roi_search=False, roi_scales=(2, 4, 8), nms_iou=None,
+                 nms_max_candidates=None, prefetch_workers=4, prefetch_timeout=60, download_workers=8):
         self.api_key = api_key
         if local_cache_directory is None:
             if os.name == 'nt':
@@ -30,24 +103,128 @@ class LocalClassifier:
             local_cache_directory = os.path.expanduser(local_cache_directory)
         self.local_cache_directory = local_cache_directory
         os.makedirs(local_cache_directory, exist_ok=True)
-        self.network_utils = NetworkUtils(url)
+        self.network_utils = NetworkUtils(url, session=session)
         self.elements_data_filename = os.path.join(local_cache_directory, 'element_data.json')
-        self.elements_data = {}
+        # Decoded templates and element data, read on demand
+        self.template_store = TemplateStore(os.path.join(local_cache_directory, 'templates'))
+        self.elements_data = ElementIndex(self.template_store)
         self.template_match_threshold = template_match_threshold
+        self.template_cache = template_cache
+        if template_cache_bytes is not None:
+            self.template_cache.resize(template_cache_bytes)
+        # OpenCV releases the GIL during matchTemplate, so templates can be matched on several threads at once
+        self.executor = None
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='devtools-ai-match')
+        # Coarse to fine search: match a downscaled grayscale screenshot first, then refine at full resolution around the
+        # coarse candidates. Scores, and so template_match_threshold, always come from the full resolution match.
+        # Downscaling averages noise out, so a match clearing the default threshold (a 0.002 difference) stays well
+        # under the coarse threshold. More than pyramid_max_candidates separate candidate areas use the full search.
+        self.pyramid_scale = pyramid_scale if pyramid_scale is not None and 0 < pyramid_scale < 1 else None
+        self.pyramid_coarse_threshold = pyramid_coarse_threshold
+        self.pyramid_max_candidates = pyramid_max_candidates
+        # Search windows of increasing size (in template sizes) around the recorded action infos before the whole screenshot
+        self.roi_search = roi_search
+        self.roi_scales = roi_scales
+        # Collapse the overlapping hits of a template into distinct candidates, keeping the best one of each group.
+        # Without nms_iou a cap keeps the hits around the best peak only, so other copies of the element are dropped.
+        self.nms_iou = nms_iou
+        self.nms_max_candidates = nms_max_candidates
+        # Templates of the test case elements are downloaded in the background, classifying an element only waits for
+        # its own templates, up to prefetch_timeout seconds
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_timeout = prefetch_timeout
+        self.prefetch_queue = None
+        self._prefetching = {}
+        self._elements_data_lock = threading.Lock()
+        # Template downloads of every element share download_workers threads and the connections of the session
+        self.download_workers = download_workers
+        self.download_queue = None
+        self._downloads = {}
+        self._downloads_lock = threading.Lock()
+        self._closed = False
         self.load_known_elements()
 
     def load_known_elements(self):
-        if os.path.exists(self.elements_data_filename):
+        # Imports the element data written by older versions, once
+        if os.path.exists(self.elements_data_filename) and len(self.elements_data) == 0:
             with open(self.elements_data_filename, 'r') as f:
-                self.elements_data = json.load(f)
+                self.elements_data.update_many(json.load(f))
 
     def save_elements_data(self):
-        with open(self.elements_data_filename, 'w') as f:
-            json.dump(self.elements_data, f)
+        """
+        Element data is written to the template store as soon as it is set, nothing is left to save.
+        """
+        pass
+
+    def prefetch(self, element_names):
+        """
+        Caches the templates of the elements from background threads, see wait_for_prefetch.
+        """
+        for element_name in element_names:
+            with self._elements_data_lock:
+                # The check-in callback may only run once the driver quit
+                if self._closed:
+                    return
+                if element_name in self._prefetching:
+                    continue
+                done = threading.Event()
+                self._prefetching[element_name] = done
+                if self.prefetch_queue is None:
+                    self.prefetch_queue = BackgroundTaskQueue(max_size=0, workers=self.prefetch_workers,
+                                                              name='devtools-ai-prefetch')
+            if not self.prefetch_queue.submit(self._prefetch_element, element_name, done):
+                done.set()
+
+    def _prefetch_element(self, element_name, done):
+        try:
+            self.cache_templates_for_element(element_name)
+        finally:
+            done.set()
+
+    def wait_for_prefetch(self, element_names, timeout=None):
+        """
+        Waits for the templates of the elements being prefetched. Returns False if the timeout expired first.
+        """
+        if timeout is None:
+            timeout = self.prefetch_timeout
+        end = time.time() + timeout
+        for element_name in element_names:
+            done = self._prefetching.get(element_name)
+            if done is not None and not done.wait(max(0.0, end - time.time())):
+                log.info(f'Templates of element {element_name} still downloading after {timeout}s')
+                return False
+        return True
+
+    def close(self, timeout=None):
+        """
+        Stops the prefetch, download and matching threads and closes the template store. The running prefetches finish
+        first, without starting new downloads; timeout bounds the wait for each queue.
+        """
+        with self._elements_data_lock, self._downloads_lock:
+            self._closed = True
+        # Prefetches wait for their downloads, so their queue is closed first
+        if self.prefetch_queue is not None:
+            self.prefetch_queue.close(timeout)
+        if self.download_queue is not None:
+            self.download_queue.close(timeout)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.template_store.close()
 
     def get_template_path(self, template_uuid):
+        # Png written by older versions
+        return os.path.join(self.local_cache_directory, template_uuid + '.png')
+
+    def get_legacy_template_path(self, template_uuid):
+        # Base64 copy written by older versions
         return os.path.join(self.local_cache_directory, template_uuid)
 
+    def has_template(self, template_uuid):
+        return self.template_store.contains(template_uuid) or \
+            os.path.exists(self.get_template_path(template_uuid)) or \
+            os.path.exists(self.get_legacy_template_path(template_uuid))
+
     def cache_templates_for_element(self, element_name):
         try:
             log.debug(f'Caching template for element {element_name}')
@@ -56,76 +233,194 @@ class LocalClassifier:
             if element_template_data['success']:
                 self.elements_data[element_name] = element_template_data
                 log.debug(f'Found {len(element_template_data["templates"])} templates for element {element_name}')
+                downloads = []
                 for template in element_template_data['templates']:
                     template_uuid = template['template_uuid']
-                    if not os.path.exists(os.path.join(self.local_cache_directory, template_uuid)):
-                        log.debug(f'caching template {template_uuid}')
-                        data = {
-                            'screenshot_uuid': template_uuid,
-                            'api_key': self.api_key,
-                            'label': element_name
-                        }
-                        template_image = self.network_utils.make_json_post_request('/retrieve_element', data, 'Error retrieving element', 30)
-                        if template_image['success']:
-                            with open(self.get_template_path(template_uuid), 'wb') as f:
-                                f.write(template_image['screenshot_b64'].encode('utf-8'))
-                            cv2.imwrite(self.get_template_path(template_uuid) + '.png', b642cv2(template_image['screenshot_b64']))
+                    if not self.has_template(template_uuid):
+                        downloads.append(self.download_template(template_uuid, element_name))
                     else:
                         log.debug(f'Template already cached {template_uuid}')
+                for done in downloads:
+                    done.wait()
         except Exception as e:
             log.exception(e)
             log.error(f'Error caching template for element {element_name}: {e}')
-        self.save_elements_data()
+
+    def download_template(self, template_uuid, element_name):
+        """
+        Downloads the template on the download threads, once even if several elements share it.
+        Returns an event set when the download is over.
+        """
+        with self._downloads_lock:
+            done = self._downloads.get(template_uuid)
+            if done is not None:
+                return done
+            done = threading.Event()
+            if self._closed:
+                done.set()
+                return done
+            self._downloads[template_uuid] = done
+            if self.download_queue is None:
+                self.download_queue = BackgroundTaskQueue(max_size=0, workers=self.download_workers,
+                                                          name='devtools-ai-download')
+        if not self.download_queue.submit(self._download_template, template_uuid, element_name, done):
+            with self._downloads_lock:
+                self._downloads.pop(template_uuid, None)
+            done.set()
+        return done
+
+    def _download_template(self, template_uuid, element_name, done):
+        try:
+            log.debug(f'caching template {template_uuid}')
+            data = {
+                'screenshot_uuid': template_uuid,
+                'api_key': self.api_key,
+                'label': element_name
+            }
+            template_image = self.network_utils.make_json_post_request('/retrieve_element', data, 'Error retrieving element', 30)
+            if template_image['success']:
+                self.write_template(template_uuid, template_image['screenshot_b64'])
+        finally:
+            with self._downloads_lock:
+                self._downloads.pop(template_uuid, None)
+            done.set()
+
+    def write_template(self, template_uuid, template_b64):
+        """
+        Decodes the template once and appends its pixels to the template store.
+        """
+        self.template_store.put(template_uuid, b642cv2(template_b64))
 
     def classify_element(self, element_name, screenshot_b64):
         #classify logic
         try:
+            self.wait_for_prefetch([element_name])
             if element_name not in self.elements_data:
                 log.info(f'Element {element_name} not found in local cache, using online prediction')
                 return None
-            res = self.do_template_match(element_name, screenshot_b64)
             img = b642cv2(screenshot_b64)
-            predicted_element, score = self.find_best_candidate_wrapper(res, self.elements_data[element_name], img)
-            if predicted_element is not None:
-                log.info(f'Classified locally element {element_name} with score {score}')
-            else:
-                log.info(f'Could not classify locally element {element_name} using web prediction')
-            return predicted_element
+            res = self.do_template_match(element_name, screenshot_b64, img=img)
+            return self._predict_element(element_name, res, img)
         except Exception as e:
             log.exception(e)
             log.error(f'Error doing local classification of element {element_name}')
             return None
 
+    def classify_elements(self, element_names, screenshot_b64):
+        """
+        Classifies several elements against the same screenshot, matching all their templates in one batch.
+        Returns a dict of element name to predicted box, None for the elements that could not be classified locally.
+        """
+        predictions = {element_name: None for element_name in element_names}
+        self.wait_for_prefetch(element_names)
+        known_names = [element_name for element_name in element_names if element_name in self.elements_data]
+        for element_name in element_names:
+            if element_name not in self.elements_data:
+                log.info(f'Element {element_name} not found in local cache, using online prediction')
+        try:
+            img = b642cv2(screenshot_b64)
+            results = self.do_template_match_batch(known_names, img)
+        except Exception as e:
+            log.exception(e)
+            log.error(f'Error doing local classification of elements {known_names}')
+            return predictions
+        for element_name in known_names:
+            try:
+                predictions[element_name] = self._predict_element(element_name, results[element_name], img)
+            except Exception as e:
+                log.exception(e)
+                log.error(f'Error doing local classification of element {element_name}')
+        return predictions
+
+    def _predict_element(self, element_name, res, img):
+        predicted_element, score = self.find_best_candidate_wrapper(res, self.elements_data[element_name], img)
+        if predicted_element is not None:
+            log.info(f'Classified locally element {element_name} with score {score}')
+        else:
+            log.info(f'Could not classify locally element {element_name} using web prediction')
+        return predicted_element
+
     def find_best_candidate_wrapper(self, res, element_data, img):
         # naive matching for now, TODO implement geographic matching based on element data
         res['action_infos'] = element_data['action_infos']
         pred_element, score = self.find_best_candidate(res, img, threshold=self.template_match_threshold)
         return pred_element, score
 
-    def do_template_match(self, element_name, screenshot_b64):
-        templates_uuids = [data['template_uuid'] for data in self.elements_data[element_name]['templates']]
+    def load_template(self, template_uuid):
+        template = self.template_cache.get(template_uuid)
+        if template is None:
+            template = self.template_store.get(template_uuid)
+            if template is None:
+                template = self.load_legacy_template(template_uuid)
+            if template is not None:
+                self.template_cache.put(template_uuid, template)
+        return template
+
+    def load_legacy_template(self, template_uuid):
+        """
+        Decodes a template cached by an older version and moves it to the template store.
+        """
+        template = None
+        if os.path.exists(self.get_template_path(template_uuid)):
+            with open(self.get_template_path(template_uuid), 'rb') as f:
+                template = cv2.imdecode(np.frombuffer(f.read(), np.uint8), cv2.IMREAD_COLOR)
+        elif os.path.exists(self.get_legacy_template_path(template_uuid)):
+            with open(self.get_legacy_template_path(template_uuid), 'rb') as f:
+                template = b642cv2(f.read().decode('utf-8'))
+        if template is not None:
+            self.template_store.put(template_uuid, template)
+        return template
+
+    def template_cache_stats(self):
+        return self.template_cache.stats()
+
+    def template_store_stats(self):
+        return self.template_store.stats()
+
+    def load_templates(self, element_name):
         templates = []
-        for template_uuid in templates_uuids:
-            if os.path.exists(os.path.join(self.local_cache_directory, template_uuid)):
-                with open(os.path.join(self.local_cache_directory, template_uuid), 'rb') as f:
-                    template_b64 = f.read().decode('utf-8')
-                    template = b642cv2(template_b64)
-                    templates.append(template)
-
-        img = b642cv2(screenshot_b64)
-        res = {
-            'boxes': [],
-            'scores': []
-        }
-
-        for template in templates:
-            log.debug(f'Performing template match for element {element_name}')
-            boxes, scores = self.template_match_core_multi(img, template)
+        for data in self.elements_data[element_name]['templates']:
+            template = self.load_template(data['template_uuid'])
+            if template is not None:
+                templates.append(template)
+        return templates
+
+    def do_template_match(self, element_name, screenshot_b64, img=None):
+        if img is None:
+            img = b642cv2(screenshot_b64)
+        return self.do_template_match_batch([element_name], img)[element_name]
+
+    def do_template_match_batch(self, element_names, img):
+        jobs = [(element_name, template) for element_name in element_names for template in self.load_templates(element_name)]
+        small_img = None
+        if self.pyramid_scale is not None and len(jobs) > 0:
+            small_img = self.downscale_gray(img)
+        roi_centers = {}
+        if self.roi_search:
+            for element_name in element_names:
+                roi_centers[element_name] = self.get_roi_centers(self.elements_data[element_name], img.shape)
+
+        def match(job):
+            log.debug(f'Performing template match for element {job[0]}')
+            if len(roi_centers.get(job[0], [])) > 0:
+                return self.template_match_core_roi(img, job[1], roi_centers[job[0]], small_img)
+            if small_img is not None:
+                return self.template_match_core_pyramid(img, job[1], small_img)
+            return self.template_match_core_multi(img, job[1])
+
+        if self.executor is not None and len(jobs) > 1:
+            matches = self.executor.map(match, jobs)
+        else:
+            matches = map(match, jobs)
+
+        results = {element_name: {'boxes': [], 'scores': []} for element_name in element_names}
+        for (element_name, _), (boxes, scores) in zip(jobs, matches):
+            res = results[element_name]
             for box, score in zip(boxes, scores):
                 if score > self.template_match_threshold:
                     res['boxes'].append(box)
                     res['scores'].append(score)
-        return res
+        return results
 
     def template_match_core_multi(self, img, template):
         method = cv2.TM_SQDIFF_NORMED
@@ -135,13 +430,145 @@ class LocalClassifier:
 
         boxes = []
         scores = []
-        coords = np.column_stack(np.where(res <= min_val * 1.03))
-        for coord in coords:
-            top_left = coord
-            box = {'x': top_left[1], 'y': top_left[0], 'width': w, 'height': h}
-            score = res[coord[0], coord[1]]
+        ys, xs = np.where(res <= min_val * 1.03 + self.MATCH_ROUNDING)
+        values = res[ys, xs]
+        for idx in self.select_peaks(ys, xs, values, w, h):
+            box = {'x': xs[idx], 'y': ys[idx], 'width': w, 'height': h}
             boxes.append(box)
-            scores.append(1.0 - score)
+            scores.append(1.0 - values[idx])
+        return boxes, scores
+
+    def select_peaks(self, ys, xs, values, w, h):
+        """
+        Greedy non-maximum suppression over same size boxes with top left corners (ys, xs) and TM_SQDIFF_NORMED values.
+        Returns the indices of the kept boxes in their original (row-major) order. Without nms_iou no box is suppressed,
+        in both cases at most nms_max_candidates boxes with the lowest values are kept, all of them when it is None.
+        """
+        if len(values) == 0:
+            return np.arange(0)
+        if self.nms_iou is None:
+            if not self.nms_max_candidates or len(values) <= self.nms_max_candidates:
+                return np.arange(len(values))
+            order = np.argsort(np.asarray(values, dtype=np.float64), kind='stable')
+            return np.sort(order[:self.nms_max_candidates])
+        ys = np.asarray(ys, dtype=np.float64)
+        xs = np.asarray(xs, dtype=np.float64)
+        order = np.argsort(values, kind='stable')
+        suppressed = np.zeros(len(values), dtype=bool)
+        keep = []
+        for idx in order:
+            if suppressed[idx]:
+                continue
+            keep.append(idx)
+            if self.nms_max_candidates and len(keep) >= self.nms_max_candidates:
+                break
+            overlap = np.clip(w - np.abs(xs - xs[idx]), 0, None) * np.clip(h - np.abs(ys - ys[idx]), 0, None)
+            suppressed |= overlap / (2.0 * w * h - overlap) > self.nms_iou
+        return np.sort(keep)
+
+    def downscale_gray(self, img):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
+        return cv2.resize(gray, None, fx=self.pyramid_scale, fy=self.pyramid_scale, interpolation=cv2.INTER_AREA)
+
+    def template_match_core_pyramid(self, img, template, small_img):
+        """
+        Same output as template_match_core_multi, but the full resolution match only runs in windows around the
+        candidates found on the downscaled grayscale images. The template is downscaled once per alignment of the
+        downscale grid, so every copy of the element matches one of them as well as it matches the screenshot.
+        Falls back to the full search when no window holds a match over template_match_threshold, or when the windows
+        would cost about as much as the full search.
+        """
+        h, w, c = template.shape
+        step = int(np.ceil(1.0 / self.pyramid_scale))
+        # Whole downscale cells fitting in the template whatever its alignment
+        ch = (h - step + 1) // step * step
+        cw = (w - step + 1) // step * step
+        sh, sw = ch // step, cw // step
+        if sh < 4 or sw < 4 or sh > small_img.shape[0] or sw > small_img.shape[1]:
+            # Too small to be matched reliably once downscaled
+            return self.template_match_core_multi(img, template)
+
+        # Small grid cells where the template, cropped (dy, dx) pixels into it, matches under the coarse threshold: a
+        # copy whose top left corner is (dy, dx) pixels before a cell boundary is downscaled along the same cells
+        candidates = np.zeros(small_img.shape[:2], dtype=np.uint8)
+        for dy in range(step):
+            for dx in range(step):
+                shifted = self.downscale_gray(template[dy:dy + ch, dx:dx + cw])
+                coarse = cv2.matchTemplate(small_img, shifted, cv2.TM_SQDIFF_NORMED)
+                hits = (coarse <= self.pyramid_coarse_threshold).astype(np.uint8)
+                region = candidates[:hits.shape[0], :hits.shape[1]]
+                np.bitwise_or(region, hits, out=region)
+
+        # Neighbouring candidates share a window, a cell is refined over the step x step top left corners it stands for
+        _, _, stats, _ = cv2.connectedComponentsWithStats(candidates, connectivity=8)
+        windows = []
+        area = 0
+        for x, y, width, height, _ in stats[1:]:
+            window = (int(y / self.pyramid_scale) - step, int(x / self.pyramid_scale) - step,
+                      int((y + height) / self.pyramid_scale) + step, int((x + width) / self.pyramid_scale) + step)
+            windows.append(window)
+            area += (window[2] - window[0] + h) * (window[3] - window[1] + w)
+        if len(windows) > self.pyramid_max_candidates or area > img.shape[0] * img.shape[1] / 4:
+            log.debug(f'{len(windows)} coarse candidate windows, using the full search')
+            return self.template_match_core_multi(img, template)
+
+        boxes, scores = self.template_match_core_windows(img, template, windows)
+        if not any(score > self.template_match_threshold for score in scores):
+            return self.template_match_core_multi(img, template)
+        return boxes, scores
+
+    def template_match_core_roi(self, img, template, centers, small_img=None):
+        """
+        Searches windows of growing size around the given centers (in pixels), and the whole screenshot only if no match
+        clears template_match_threshold in any of them.
+        """
+        h, w, c = template.shape
+        for scale in self.roi_scales:
+            half_h = h * scale / 2
+            half_w = w * scale / 2
+            windows = []
+            for cx, cy in centers:
+                windows.append((int(cy - half_h), int(cx - half_w), int(cy + half_h) - h, int(cx + half_w) - w))
+            boxes, scores = self.template_match_core_windows(img, template, windows)
+            if any(score > self.template_match_threshold for score in scores):
+                log.debug(f'Found template match around recorded action infos with window scale {scale}')
+                return boxes, scores
+        if small_img is not None:
+            return self.template_match_core_pyramid(img, template, small_img)
+        return self.template_match_core_multi(img, template)
+
+    def template_match_core_windows(self, img, template, windows):
+        """
+        Same output as template_match_core_multi, restricted to the top left corners inside the given
+        (y0, x0, y1, x1) windows.
+        """
+        h, w, c = template.shape
+        max_y = img.shape[0] - h
+        max_x = img.shape[1] - w
+        matches = {}
+        for y0, x0, y1, x1 in windows:
+            y0 = max(0, y0)
+            x0 = max(0, x0)
+            y1 = min(max_y, y1)
+            x1 = min(max_x, x1)
+            if y1 < y0 or x1 < x0:
+                continue
+            res = cv2.matchTemplate(img[y0:y1 + h, x0:x1 + w], template, cv2.TM_SQDIFF_NORMED)
+            for ry, rx in zip(*np.where(res <= res.min() * 1.03 + self.MATCH_ROUNDING)):
+                matches[(y0 + int(ry), x0 + int(rx))] = float(res[ry, rx])
+        if not matches:
+            return [], []
+
+        min_val = min(matches.values())
+        coords = [coord for coord in sorted(matches) if matches[coord] <= min_val * 1.03 + self.MATCH_ROUNDING]
+        values = [matches[coord] for coord in coords]
+        ys = [coord[0] for coord in coords]
+        xs = [coord[1] for coord in coords]
+        boxes = []
+        scores = []
+        for idx in self.select_peaks(ys, xs, values, w, h):
+            boxes.append({'x': xs[idx], 'y': ys[idx], 'width': w, 'height': h})
+            scores.append(1.0 - values[idx])
         return boxes, scores
 
     def cdist(self, centers_a, center_b):
@@ -155,67 +582,55 @@ class LocalClassifier:
         return x >= 0 and y >= 0 and x + w <= shape[1] and y + h <= shape[0]
 
     def get_boxes_centers(self, boxes, img_shape):
-        box_centers = []
-        for box in boxes:
-            h, w, c = img_shape
-            normalized_box = {'x': box['x'] / w, 'y': box['y'] / h, 'width': box['width'] / w,
-                              'height': box['height'] / h}
-            vec_box_center = np.array(
-                [normalized_box['x'] + normalized_box['width'] / 2, normalized_box['y'] + normalized_box['height'] / 2])
-            box_centers.append(vec_box_center)
-        return np.array(box_centers)
+        h, w = img_shape[0], img_shape[1]
+        if len(boxes) == 0:
+            return np.zeros((0, 2))
+        rects = np.array([[box['x'], box['y'], box['width'], box['height']] for box in boxes], dtype=np.float64)
+        return np.column_stack([rects[:, 0] / w + rects[:, 2] / w / 2, rects[:, 1] / h + rects[:, 3] / h / 2])
 
     def find_best_candidate(self, res, img, mode='geographic', threshold=0.9999):
-        #TODO use image shape
+        """
+        Picks, among the boxes inside the screenshot scoring at least threshold, the one closest to any recorded action info.
+        Ties go to the first box, like the previous pairwise scan.
+        Raises ValueError where the previous scan did, when it had to rank an empty list: there is no action info, or
+        the first box inside the screenshot scores under threshold.
+        """
+        predicted_element = None
         score = None
         log.debug(f'Finding best candidate from results')
-        if res is not None:
-            oscores = res['scores']
-            oboxes = res['boxes']
-            img_shape = img.shape
-
-            scores = []
-            boxes = []
-            for score, box in zip(oscores, oboxes):
-                if self.box_in_screenshot(box, img_shape):
-                    boxes.append(box)
-                    scores.append(score)
-
-            log.debug(f'Length of scores: {len(scores)}')
-            if len(scores) > 0 and len(boxes) > 0:
-                max_score = max(scores)
-                if mode == 'geographic':
-                    cut_off = threshold
-                    geographic_scores = []
-                    geographic_boxes = []
-                    for score, box in zip(scores, boxes):
-                        if score >= cut_off:
-                            geographic_scores.append(score)
-                            geographic_boxes.append(box)
-
-                        vec_action_infos_centers = self.get_action_infos_centers(res['action_infos'])
-                        vec_box_centers = self.get_boxes_centers(geographic_boxes, img_shape)
-
-                        dists = []
-                        for idx_box in range(len(vec_box_centers)):
-                            for idx_action_info in range(len(vec_action_infos_centers)):
-                                dist = self.cdist([vec_box_centers[idx_box]], vec_action_infos_centers[idx_action_info])
-                                dists.append((idx_box, dist))
-                        amin = min(dists, key=lambda el: el[1])[0]
-                        best_geographic_box = geographic_boxes[amin]
-                        best_geographic_score = geographic_scores[amin]
-
-                        predicted_element = best_geographic_box
-                        score = best_geographic_score
-                        log.debug(f'Found a best geographic match {best_geographic_score} {best_geographic_box}')
-            else:
-                predicted_element = None
-                score = None
-        else:
-            predicted_element = None
-            score = None
+        if res is None or len(res['boxes']) == 0:
+            return predicted_element, score
+
+        img_shape = img.shape
+        boxes = res['boxes']
+        scores = np.asarray(res['scores'], dtype=np.float64)
+        rects = np.array([[box['x'], box['y'], box['width'], box['height']] for box in boxes], dtype=np.float64)
+        in_screenshot = (rects[:, 0] >= 0) & (rects[:, 1] >= 0) & (rects[:, 0] + rects[:, 2] <= img_shape[1]) & \
+                        (rects[:, 1] + rects[:, 3] <= img_shape[0])
+        log.debug(f'Length of scores: {int(in_screenshot.sum())}')
+        if mode == 'geographic' and in_screenshot.any():
+            candidates = np.flatnonzero(in_screenshot & (scores >= threshold))
+            vec_action_infos_centers = self.get_action_infos_centers(res['action_infos'])
+            # The previous scan ranked the kept boxes after every box inside the screenshot, starting with the first
+            if len(vec_action_infos_centers) == 0 or len(candidates) == 0 or candidates[0] != np.argmax(in_screenshot):
+                raise ValueError('No candidate box to rank against the action infos')
+            vec_box_centers = self.get_boxes_centers([boxes[idx] for idx in candidates], img_shape)
+            # (boxes, action infos) distance matrix, the flat argmin is the first minimum in box order
+            diffs = vec_box_centers[:, None, :] - vec_action_infos_centers[None, :, :]
+            dists = np.sqrt((diffs ** 2).sum(axis=2))
+            best = candidates[int(np.argmin(dists)) // dists.shape[1]]
+            predicted_element = boxes[best]
+            score = res['scores'][best]
+            log.debug(f'Found a best geographic match {score} {predicted_element}')
         return predicted_element, score
 
+    def get_roi_centers(self, element_data, img_shape):
+        action_infos = element_data.get('action_infos', [])
+        if len(action_infos) == 0:
+            return []
+        centers = self.get_action_infos_centers(action_infos)
+        return centers * np.array([img_shape[1], img_shape[0]])
+
     def get_action_infos_centers(self, action_infos):
         entity_centers = []
         for action_info in action_infos:
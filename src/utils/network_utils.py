@@ -1,11 +1,50 @@
 import requests
 import logging
 
+from requests.adapters import HTTPAdapter
+
 log = logging.getLogger(__name__)
 
+
+class PooledSession(requests.Session):
+    """
+    Keep-alive session backed by a urllib3 connection pool, shared by every service call of a driver.
+    :Args:
+     - pool_connections: Number of per-host pools to keep around.
+     - pool_maxsize: Maximum number of connections kept open per host.
+     - pool_block: If True, never open more than pool_maxsize connections to a host and wait for a free one instead.
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=10, pool_block=False):
+        super(PooledSession, self).__init__()
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self.mount('https://', self.adapter)
+        self.mount('http://', self.adapter)
+        self.headers['Connection'] = 'keep-alive'
+
+    def connection_stats(self):
+        """
+        Returns the number of requests sent, and how many of them opened a new connection vs. reused a pooled one.
+        """
+        num_requests = 0
+        new_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            new_connections += pool.num_connections
+        return {'requests': num_requests,
+                'new_connections': new_connections,
+                'reused_connections': max(0, num_requests - new_connections)}
+
+
 class NetworkUtils:
-    def __init__(self, url):
+    def __init__(self, url, session=None):
         self.url = url
+        if session is None:
+            session = PooledSession()
+        self.session = session
 
     def make_json_post_request(self, route, data, timeout_error_message, timeout_variable, generic_error_message=None,
                                tries=3):
@@ -18,7 +57,7 @@ class NetworkUtils:
             try:
                 log.debug('Making request to ' + route)
                 url = self.url.rstrip('/') + route
-                res = requests.post(url, json=data, verify=False, timeout=local_timeout).json()
+                res = self.session.post(url, json=data, verify=False, timeout=local_timeout).json()
                 break
             except requests.exceptions.ConnectTimeout:
                 local_timeout = local_timeout * 2
@@ -0,0 +1,150 @@
+import contextlib
+import email.utils
+import logging
+import threading
+import time
+
+from urllib.parse import urlparse
+
+log = logging.getLogger(__name__)
+
+
+class _HostState:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = burst
+        self.refilled_at = time.time()
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.backoff_level = 0
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+
+class HostScheduler:
+    """
+    Paces the requests sent to every host: a token bucket of rate requests per second, at most max_in_flight requests
+    at a time, and an adaptive backoff when the host answers 429 or 503.
+    :Args:
+     - rate: Requests per second allowed per host, None for no limit.
+     - burst: Requests that can be sent at once before the rate applies.
+     - max_in_flight: Maximum number of concurrent requests per host, None for no limit.
+     - backoff: First pause after a throttled response, doubled on every consecutive one, unless the host sent
+       a Retry-After.
+     - max_backoff: Longest pause.
+     - min_rate: The rate is halved on every throttled response, down to min_rate, and recovers by a tenth of rate on
+       every successful request.
+    """
+    THROTTLE_STATUSES = (429, 503)
+
+    def __init__(self, rate=None, burst=1, max_in_flight=None, backoff=1.0, max_backoff=60.0, min_rate=0.1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_in_flight = max_in_flight
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.min_rate = min_rate
+        self._hosts = {}
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        """
+        Waits until a request to the host of url may be sent, and holds one of its in-flight slots meanwhile.
+        """
+        self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        start = time.time()
+        with self._condition:
+            state = self._state(host)
+            while True:
+                now = time.time()
+                if state.rate:
+                    state.tokens = min(self.burst, state.tokens + (now - state.refilled_at) * state.rate)
+                state.refilled_at = now
+                if self.max_in_flight and state.in_flight >= self.max_in_flight:
+                    self._condition.wait()
+                    continue
+                if now < state.blocked_until:
+                    self._condition.wait(state.blocked_until - now)
+                    continue
+                if state.rate and state.tokens < 1:
+                    self._condition.wait((1 - state.tokens) / state.rate)
+                    continue
+                if state.rate:
+                    state.tokens -= 1
+                state.in_flight += 1
+                state.requests += 1
+                state.waited += now - start
+                return
+
+    def release(self, url):
+        with self._condition:
+            state = self._state(urlparse(url).netloc)
+            state.in_flight = max(0, state.in_flight - 1)
+            self._condition.notify_all()
+
+    def throttled(self, url, retry_after=None):
+        """
+        Records a 429 / 503 from the host of url: no request is sent to it for a while and its rate is lowered.
+        """
+        host = urlparse(url).netloc
+        delay = self.parse_retry_after(retry_after)
+        with self._condition:
+            state = self._state(host)
+            state.throttled += 1
+            state.backoff_level += 1
+            if delay is None:
+                delay = min(self.max_backoff, self.base_backoff * 2 ** (state.backoff_level - 1))
+            delay = min(self.max_backoff, delay)
+            state.blocked_until = max(state.blocked_until, time.time() + delay)
+            if state.rate:
+                state.rate = max(self.min_rate, state.rate / 2)
+            self._condition.notify_all()
+        log.info(f'{host} is throttling the crawl, pausing for {delay:.1f}s')
+
+    def succeeded(self, url):
+        """
+        Records a request to the host of url that was not throttled.
+        """
+        with self._condition:
+            state = self._state(urlparse(url).netloc)
+            state.backoff_level = max(0, state.backoff_level - 1)
+            if self.rate and state.rate < self.rate:
+                state.rate = min(self.rate, state.rate + self.rate / 10)
+
+    def stats(self):
+        with self._condition:
+            return {host: {'requests': s.requests, 'throttled': s.throttled, 'rate': s.rate,
+                           'in_flight': s.in_flight, 'waited': s.waited}
+                    for host, s in self._hosts.items()}
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Returns the number of seconds of a Retry-After header, given in seconds or as an HTTP date.
+        """
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = _HostState(self.rate, self.burst)
+            self._hosts[host] = state
+        return state
@@ -1,30 +1,295 @@
+from collections import deque
+import contextlib
+import sqlite3
+import threading
+import time
+
+
 class LinkManager:
-    def __init__(self):
-        self.links_visited = []
-        self.links_to_visit = []
-        self.referrers = []
-        self.depths = []
+    """
+    Frontier and visited links of a crawl.
+    :Args:
+     - canonicalizer: Callable mapping a link to the key it is deduplicated on, see URLCanonicalizer. The frontier
+       keeps the links as they were found, those are the ones loaded and reported.
+    """
+    def __init__(self, canonicalizer=None):
+        self.canonicalizer = canonicalizer
+        # Keys of the visited links
+        self.links_visited = set()
+        # (referrer, link, depth) records, in crawl order
+        self.frontier = deque()
+        # Keys of the links waiting in the frontier or being processed
+        self.links_queued = set()
+        self.links_failed = set()
 
     def add_link(self, referrer, link, depth=0):
-        if not self.seen(link) and not link in self.links_to_visit:
-            self.links_to_visit.append(link)
-            self.referrers.append(referrer)
-            self.depths.append(depth)
+        key = self.key(link)
+        if key not in self.links_visited and key not in self.links_queued:
+            self.frontier.append((referrer, link, depth))
+            self.links_queued.add(key)
+
+    def add_links(self, referrer, links, depth=0):
+        for link in links:
+            self.add_link(referrer, link, depth)
 
     def get_link(self):
-        return self.referrers.pop(0), self.links_to_visit.pop(0), self.depths.pop(0)
+        return self.frontier.popleft()
 
     def visited_link(self, link):
-        self.links_visited.append(link)
+        key = self.key(link)
+        self.links_visited.add(key)
+        self.links_queued.discard(key)
+
+    def failed_link(self, link):
+        # Left in links_queued, so it is not queued again
+        self.links_failed.add(self.key(link))
+
+    def failed_count(self):
+        return len(self.links_failed)
 
     def visited_count(self):
         return len(self.links_visited)
 
     def has_more_links(self):
-        return len(self.links_to_visit) > 0
+        return len(self.frontier) > 0
 
     def seen(self, link):
-        return link in self.links_visited
+        return self.key(link) in self.links_visited
+
+    def key(self, link):
+        return self.canonicalizer(link) if self.canonicalizer else link
+
+    def has_pending_links(self):
+        """
+        Whether links taken from the frontier by another crawler are still being processed.
+        """
+        return False
+
+    def close(self):
+        pass
+
+
+class PersistentLinkManager(LinkManager):
+    """
+    LinkManager checkpointed to a SQLite database (WAL mode), keyed by crawl_iteration.
+    A crawl restarted with the same path and crawl_iteration resumes where the previous one stopped, and several
+    processes crawling the same crawl_iteration share their frontier and visited set.
+    :Args:
+     - path: The database file, created if needed.
+     - crawl_iteration: The crawl the links belong to.
+     - lease_timeout: Links taken by a crawler that did not mark them visited or failed within that many seconds
+       (crashed or killed run) are queued again.
+     - max_attempts: Number of times a link is tried before it is marked failed for good.
+     - requeue_in_progress: Queue again right away the links of this crawl_iteration that are being processed. Only
+       safe when no other crawler shares the crawl_iteration, otherwise the lease takes care of the crashed runs.
+     - canonicalizer: Callable mapping a link to the key it is deduplicated on, stored in the link column. The url
+       column keeps the link as it was found.
+    """
+    QUEUED = 0
+    IN_PROGRESS = 1
+    VISITED = 2
+    FAILED = 3
+
+    def __init__(self, path, crawl_iteration, lease_timeout=600, max_attempts=3, requeue_in_progress=False,
+                 canonicalizer=None):
+        self.canonicalizer = canonicalizer
+        self.path = path
+        self.crawl_iteration = crawl_iteration
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._lock = threading.RLock()
+        # Keys of the links this process already wrote, saves a round trip to the database for links found on many pages
+        self._known = set()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS links (
+                                 seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                 crawl_iteration TEXT NOT NULL,
+                                 link TEXT NOT NULL,
+                                 url TEXT,
+                                 referrer TEXT,
+                                 depth INTEGER NOT NULL,
+                                 state INTEGER NOT NULL,
+                                 claimed_at REAL,
+                                 attempts INTEGER NOT NULL DEFAULT 0,
+                                 UNIQUE (crawl_iteration, link))""")
+        for column in ('attempts INTEGER NOT NULL DEFAULT 0', 'url TEXT'):
+            try:
+                self.conn.execute(f'ALTER TABLE links ADD COLUMN {column}')
+            except sqlite3.OperationalError:
+                # Already there
+                pass
+        self.conn.execute('CREATE INDEX IF NOT EXISTS links_state ON links (crawl_iteration, state, seq)')
+        if requeue_in_progress:
+            with self._transaction():
+                self._release_expired(max_age=0)
+
+    def add_link(self, referrer, link, depth=0):
+        self.add_links(referrer, [link], depth)
+
+    def add_links(self, referrer, links, depth=0):
+        with self._lock:
+            new_links = {}
+            for link in links:
+                key = self.key(link)
+                if key not in self._known:
+                    new_links.setdefault(key, link)
+            if not new_links:
+                return
+            self._known.update(new_links)
+            with self._transaction():
+                self.conn.executemany('INSERT OR IGNORE INTO links '
+                                      '(crawl_iteration, link, url, referrer, depth, state) VALUES (?, ?, ?, ?, ?, ?)',
+                                      [(self.crawl_iteration, key, link, referrer, depth, self.QUEUED)
+                                       for key, link in new_links.items()])
+
+    def get_link(self):
+        """
+        Takes the oldest queued link, or returns None if another process took the last one.
+        """
+        with self._lock, self._transaction():
+            # Rows written before the url column have the link only
+            row = self.conn.execute('SELECT seq, referrer, COALESCE(url, link), depth FROM links '
+                                    'WHERE crawl_iteration = ? AND state = ? ORDER BY seq LIMIT 1',
+                                    (self.crawl_iteration, self.QUEUED)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE links SET state = ?, claimed_at = ? WHERE seq = ?',
+                              (self.IN_PROGRESS, time.time(), row[0]))
+            return row[1], row[2], row[3]
+
+    def visited_link(self, link):
+        key = self.key(link)
+        with self._lock:
+            self._known.add(key)
+            with self._transaction():
+                self.conn.execute('INSERT OR IGNORE INTO links (crawl_iteration, link, url, referrer, depth, state) '
+                                  'VALUES (?, ?, ?, NULL, 0, ?)', (self.crawl_iteration, key, link, self.VISITED))
+                self.conn.execute('UPDATE links SET state = ? WHERE crawl_iteration = ? AND link = ?',
+                                  (self.VISITED, self.crawl_iteration, key))
+
+    def failed_link(self, link):
+        """
+        Queues the link again, or marks it failed once it was tried max_attempts times.
+        """
+        with self._lock, self._transaction():
+            self.conn.execute('UPDATE links SET attempts = attempts + 1, claimed_at = NULL, '
+                              'state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END '
+                              'WHERE crawl_iteration = ? AND link = ? AND state = ?',
+                              (self.max_attempts, self.FAILED, self.QUEUED, self.crawl_iteration, self.key(link),
+                               self.IN_PROGRESS))
+
+    def failed_count(self):
+        return self._count('state = ?', (self.FAILED,))
+
+    def visited_count(self):
+        return self._count('state = ?', (self.VISITED,))
+
+    def has_more_links(self):
+        with self._lock:
+            if self._count('state = ?', (self.QUEUED,)) > 0:
+                return True
+            with self._transaction():
+                self._release_expired()
+            return self._count('state = ?', (self.QUEUED,)) > 0
+
+    def seen(self, link):
+        return self._count('link = ? AND state = ?', (self.key(link), self.VISITED)) > 0
+
+    def has_pending_links(self):
+        return self._count('state = ?', (self.IN_PROGRESS,)) > 0
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _count(self, condition, args):
+        with self._lock:
+            return self.conn.execute(f'SELECT COUNT(*) FROM links WHERE crawl_iteration = ? AND {condition}',
+                                     (self.crawl_iteration,) + args).fetchone()[0]
+
+    def _release_expired(self, max_age=None):
+        if max_age is None:
+            max_age = self.lease_timeout
+        # An expired lease counts as a failed attempt, so a link that keeps killing its crawler is given up on
+        self.conn.execute('UPDATE links SET attempts = attempts + 1, claimed_at = NULL, '
+                          'state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END '
+                          'WHERE crawl_iteration = ? AND state = ? AND claimed_at < ?',
+                          (self.max_attempts, self.FAILED, self.QUEUED, self.crawl_iteration, self.IN_PROGRESS,
+                           time.time() - max_age))
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+class PageFingerprint:
+    """
+    What a crawl saw of a page: document status and validators, rendered DOM hash, errors and same-domain links.
+    """
+    def __init__(self, url, status=None, etag=None, last_modified=None, dom_hash=None, errors=(), links=()):
+        self.url = url
+        self.status = status
+        self.etag = etag
+        self.last_modified = last_modified
+        self.dom_hash = dom_hash
+        self.errors = set(errors)
+        self.links = list(links)
+
+    def same_content(self, other):
+        return other is not None and self.dom_hash is not None and \
+            (self.status, self.dom_hash) == (other.status, other.dom_hash)
+
+
+class FingerprintStore:
+    """
+    Fingerprints of the pages of the previous crawls, in a SQLite database (WAL mode), keyed by url.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS fingerprints (
+                                 url TEXT PRIMARY KEY,
+                                 status INTEGER,
+                                 etag TEXT,
+                                 last_modified TEXT,
+                                 dom_hash TEXT,
+                                 errors TEXT NOT NULL,
+                                 links TEXT NOT NULL,
+                                 crawled_at REAL NOT NULL)""")
+        self.conn.commit()
+
+    def get(self, url):
+        with self._lock:
+            row = self.conn.execute('SELECT status, etag, last_modified, dom_hash, errors, links FROM fingerprints '
+                                    'WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return PageFingerprint(url, status=row[0], etag=row[1], last_modified=row[2], dom_hash=row[3],
+                               errors=json.loads(row[4]), links=json.loads(row[5]))
+
+    def put(self, fingerprint):
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO fingerprints '
+                              '(url, status, etag, last_modified, dom_hash, errors, links, crawled_at) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (fingerprint.url, fingerprint.status, fingerprint.etag, fingerprint.last_modified,
+                               fingerprint.dom_hash, json.dumps(sorted(fingerprint.errors)),
+                               json.dumps(fingerprint.links), time.time()))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
 
 def is_js_error(message):
     if 'error' in message.lower():
@@ -37,22 +302,201 @@ from time import sleep
 
 import json
 import logging
-import requests
 import uuid
 
-from urllib.parse import urlparse
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 import hashlib
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.common.by import By
+
+from .background import BackgroundTaskQueue
+from .network_utils import PooledSession
+from .rate_limit import HostScheduler
+
+# [tag, absolute url, x, y, width, height] of every anchor and image, in document coordinates like element.rect
+PAGE_RESOURCES_SCRIPT = """
+var resources = [];
+var sx = window.pageXOffset, sy = window.pageYOffset;
+var nodes = document.querySelectorAll('a, img');
+for (var i = 0; i < nodes.length; i++) {
+    var el = nodes[i];
+    var tag = el.tagName.toLowerCase();
+    var url = tag === 'img' ? (el.currentSrc || el.src) : el.href;
+    var r = el.getBoundingClientRect();
+    resources.push([tag, url || '', r.left + sx, r.top + sy, r.width, r.height]);
+}
+return resources;
+"""
+
+# Absolute href of every anchor then src of every image, like get_attribute('href') / get_attribute('src')
+PAGE_LINKS_SCRIPT = """
+var links = [];
+var anchors = document.getElementsByTagName('a');
+for (var i = 0; i < anchors.length; i++) {
+    // SVG anchors expose an SVGAnimatedString instead of a resolved url
+    var href = typeof anchors[i].href === 'string' ? anchors[i].href : anchors[i].getAttribute('href');
+    if (href) links.push(href);
+}
+var imgs = document.getElementsByTagName('img');
+for (var i = 0; i < imgs.length; i++) {
+    if (imgs[i].src) links.push(imgs[i].src);
+}
+return links;
+"""
+
+# Content type, location and (optionally) a 64 bit FNV-1a hash of the rendered DOM of the current page
+PAGE_INFO_SCRIPT = """
+var info = [document.contentType || '', window.location.href, null];
+if (arguments[0] && document.documentElement) {
+    var html = document.documentElement.outerHTML;
+    var h1 = 0x811c9dc5, h2 = 0x01000193 ^ html.length;
+    for (var i = 0; i < html.length; i++) {
+        var c = html.charCodeAt(i);
+        h1 = Math.imul(h1 ^ c, 0x01000193);
+        h2 = Math.imul(h2 ^ c, 0x5bd1e995);
+    }
+    info[2] = (h1 >>> 0).toString(16) + (h2 >>> 0).toString(16) + ':' + html.length;
+}
+return info;
+"""
+
+# Query parameters that only track where the visitor came from
+DEFAULT_STRIP_PARAMS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'utm_id',
+                        'gclid', 'dclid', 'fbclid', 'msclkid', 'mc_cid', 'mc_eid', '_ga', '_gl')
+
+# Links to those are never loaded as pages, broken ones are still reported from the pages that use them
+DEFAULT_SKIP_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg', '.ico', '.bmp', '.tif', '.tiff', '.avif',
+                           '.css', '.js', '.mjs', '.map', '.json', '.xml', '.txt', '.csv',
+                           '.woff', '.woff2', '.ttf', '.otf', '.eot',
+                           '.pdf', '.zip', '.gz', '.tgz', '.rar', '.7z', '.dmg', '.exe', '.msi', '.apk',
+                           '.mp3', '.mp4', '.m4a', '.wav', '.ogg', '.webm', '.mov', '.avi')
+
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+
+class URLCanonicalizer:
+    """
+    Maps the urls of a same page to a single one, so the crawler loads it once.
+    :Args:
+     - drop_fragment: Drop the #fragment.
+     - strip_params: Query parameters to drop. Names ending with '*' drop every parameter with that prefix.
+     - strip_trailing_slash: Treat /a/ and /a as the same page.
+     - sort_query: Sort the query parameters.
+    """
+    def __init__(self, drop_fragment=True, strip_params=DEFAULT_STRIP_PARAMS, strip_trailing_slash=True,
+                 sort_query=True):
+        self.drop_fragment = drop_fragment
+        self.strip_params = {p for p in strip_params if not p.endswith('*')}
+        self.strip_prefixes = tuple(p[:-1] for p in strip_params if p.endswith('*'))
+        self.strip_trailing_slash = strip_trailing_slash
+        self.sort_query = sort_query
+
+    def __call__(self, url):
+        try:
+            parsed = urlparse(url)
+        except ValueError:
+            return url
+        if parsed.scheme not in ('http', 'https'):
+            return url
+        netloc = parsed.netloc.lower()
+        if (parsed.scheme == 'http' and netloc.endswith(':80')) or (parsed.scheme == 'https' and netloc.endswith(':443')):
+            netloc = netloc.rsplit(':', 1)[0]
+        path = parsed.path or '/'
+        if self.strip_trailing_slash and len(path) > 1:
+            path = path.rstrip('/') or '/'
+        query = parsed.query
+        if query and (self.strip_params or self.strip_prefixes or self.sort_query):
+            params = [(k, v) for k, v in parse_qsl(query, keep_blank_values=True)
+                      if k not in self.strip_params and not (self.strip_prefixes and k.startswith(self.strip_prefixes))]
+            if self.sort_query:
+                params.sort()
+            query = urlencode(params)
+        fragment = '' if self.drop_fragment else parsed.fragment
+        return urlunparse((parsed.scheme, netloc, path, parsed.params, query, fragment))
+
 
 class DataManager:
-    def __init__(self, prod_url, api_key):
+    def __init__(self, prod_url, api_key, session=None, async_reporting=False, batch_size=20, timeout=10):
+        """
+        :Args:
+         - session: HTTP session to report with, a new pooled one by default.
+         - async_reporting: Buffer the findings and send them from a background thread, in batches of batch_size or
+           at the end of every page. flush() waits for everything to be sent.
+         - timeout: Timeout of every report request.
+        """
         self.prod_url = prod_url
         self.api_key = api_key
+        if session is None:
+            session = PooledSession()
+        self.session = session
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+        self.reporter = None
+        if async_reporting:
+            self.reporter = BackgroundTaskQueue(max_size=64, workers=1, drop_policy='block', block_timeout=None,
+                                                name='devtools-ai-reporter')
+
+    def _report(self, route, data):
+        if self.reporter is None:
+            self._send(route, data)
+            return
+        with self._lock:
+            self._buffer.append((route, data))
+            self.queued += 1
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.end_page()
+
+    def end_page(self):
+        """
+        Hands the findings buffered so far to the background reporter.
+        """
+        if self.reporter is None:
+            return
+        with self._lock:
+            batch = self._buffer
+            self._buffer = []
+        if batch:
+            self.reporter.submit(self._send_batch, batch)
+
+    def flush(self, timeout=None):
+        """
+        Sends the buffered findings and waits for the background reporter to be done.
+        """
+        self.end_page()
+        if self.reporter is None:
+            return True
+        return self.reporter.flush(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self.queued, 'sent': self.sent, 'failed': self.failed}
+
+    def _send_batch(self, batch):
+        for route, data in batch:
+            with self._lock:
+                self.queued -= 1
+            self._send(route, data)
+
+    def _send(self, route, data):
+        try:
+            r = self.session.post(self.prod_url + route, json=data, timeout=self.timeout)
+            success = r.status_code == 200
+        except Exception as e:
+            log.debug(f'Error reporting to {route}: {e}')
+            success = False
+        with self._lock:
+            if success:
+                self.sent += 1
+            else:
+                self.failed += 1
 
     def save_console_error(self, crawl_iteration, context_url, error_type, error_details, error_message):
         data = {
@@ -63,7 +507,7 @@ class DataManager:
             'error_details': error_details,
             'error_message': error_message,
         }
-        r = requests.post(self.prod_url + '/scanner/save_console_error', json=data)
+        self._report('/scanner/save_console_error', data)
 
     def save_network_error(self, crawl_iteration,
                                                 context_url,
@@ -88,7 +532,7 @@ class DataManager:
             'screenshot_uuid': screenshot_uuid,
             'element_location': element_location
         }
-        r = requests.post(self.prod_url + '/scanner/save_network_error', json=data)
+        self._report('/scanner/save_network_error', data)
 
     def get_screenshot_hash(self, b64_screenshot):
         """
@@ -114,7 +558,7 @@ class DataManager:
                 'crawl_iteration': crawl_iteration}
         upload_screenshot_url = self.prod_url + '/scanner/upload_screenshot'
         try:
-            r = requests.post(upload_screenshot_url, json=data, verify=False)
+            r = self.session.post(upload_screenshot_url, json=data, verify=False, timeout=self.timeout)
             if r.status_code == 200:
                 uuid = r.json()['screenshot_uuid']
                 return uuid
@@ -123,31 +567,314 @@ class DataManager:
         return None
 
 class Scanner:
-    def __init__(self, smart_driver, driver, prod_url, api_key):
+    def __init__(self, smart_driver, driver, prod_url, api_key, idle_time=0.5, load_timeout=10.0, poll_interval=0.1,
+                 async_reporting=False, report_batch_size=20, crawl_iteration=None, frontier_path=None,
+                 frontier_lease_timeout=600, resume_in_progress=False, canonicalizer=None, skip_extensions=DEFAULT_SKIP_EXTENSIONS, skip_non_html=True,
+                 dedupe_by_content=False, fingerprint_path=None, conditional_requests=True,
+                 max_requests_per_second=None, max_in_flight_per_host=None, scheduler=None):
+        """
+        :Args:
+         - idle_time: A page is ready once no network event happened for that many seconds and no request is in flight.
+         - load_timeout: Maximum time to wait for a page to be ready.
+         - poll_interval: Time between two reads of the performance log while waiting.
+         - async_reporting: Send the findings from a background thread, see DataManager.
+         - report_batch_size: Number of findings buffered before they are handed to the background thread.
+         - crawl_iteration: Id of the crawl, a new one by default. Pass the id of a previous crawl to resume it.
+         - frontier_path: SQLite file to checkpoint the frontier and visited links to, see PersistentLinkManager.
+           Crawls run with the same frontier_path and crawl_iteration resume each other and share their visited links.
+         - frontier_lease_timeout: Seconds after which a link taken from the frontier by a crawler that did not finish
+           it is queued again, see PersistentLinkManager.
+         - resume_in_progress: Queue again right away the links a previous run of this crawl_iteration was processing
+           when it stopped. Set it when resuming a crawl that nothing else runs, else the resumed crawl waits up to
+           frontier_lease_timeout for them. Crawlers sharing the crawl_iteration must leave it off.
+         - canonicalizer: Callable mapping a url to the key it is deduplicated on, a default URLCanonicalizer by
+           default. False keeps the urls as they are. Pages are loaded and reported with the url they were linked as.
+         - skip_extensions: Links with those extensions are not loaded as pages.
+         - skip_non_html: Do not follow the links of loaded documents that are not HTML.
+         - dedupe_by_content: Do not follow the links of a page whose rendered DOM is the same as a page already crawled.
+         - fingerprint_path: SQLite file keeping the fingerprint of every page between crawls, see FingerprintStore.
+           Enables the incremental mode: only the errors that were not reported by the previous crawl of a page are
+           reported, errors that went away are logged and counted, and the links of unchanged pages are reused.
+         - conditional_requests: In incremental mode, first ask the server whether a page changed since the previous
+           crawl (If-None-Match / If-Modified-Since) and do not load it in the browser if it did not.
+         - max_requests_per_second: Pages loaded per second per host, None for no limit.
+         - max_in_flight_per_host: Pages of a same host loaded at once by a parallel crawl, None for no limit.
+         - scheduler: The HostScheduler pacing the page loads, built from the two options above by default. It pauses
+           and slows down the crawl of a host answering 429 or 503.
+        """
         self.smart_driver = smart_driver
         self.driver = driver
+        self.idle_time = idle_time
+        self.load_timeout = load_timeout
+        self.poll_interval = poll_interval
         driver.execute_cdp_cmd("Network.enable", {})
         driver.execute_cdp_cmd("Console.enable", {})
-        self.link_manager = LinkManager()
-        self.data_manager = DataManager(prod_url, api_key)
-        self.crawl_iteration = str(uuid.uuid4())
+        self.crawl_iteration = crawl_iteration or str(uuid.uuid4())
+        if canonicalizer is None:
+            canonicalizer = URLCanonicalizer()
+        self.canonicalizer = canonicalizer or None
+        if frontier_path is None:
+            self.link_manager = LinkManager(canonicalizer=self.canonicalizer)
+        else:
+            self.link_manager = PersistentLinkManager(frontier_path, self.crawl_iteration,
+                                                      lease_timeout=frontier_lease_timeout,
+                                                      requeue_in_progress=resume_in_progress,
+                                                      canonicalizer=self.canonicalizer)
+        self.data_manager = DataManager(prod_url, api_key, session=getattr(smart_driver, 'http_session', None),
+                                        async_reporting=async_reporting, batch_size=report_batch_size)
+        self.skip_extensions = tuple(e.lower() for e in skip_extensions or ())
+        self.skip_non_html = skip_non_html
+        self.dedupe_by_content = dedupe_by_content
+        self.content_hashes = set()
+        self.pages_skipped = 0
+        if scheduler is None:
+            scheduler = HostScheduler(rate=max_requests_per_second, max_in_flight=max_in_flight_per_host)
+        self.scheduler = scheduler
+        self.fingerprints = FingerprintStore(fingerprint_path) if fingerprint_path else None
+        self.conditional_requests = conditional_requests
+        self.incremental_stats = {'new': 0, 'changed': 0, 'unchanged': 0, 'not_modified': 0,
+                                  'new_errors': 0, 'resolved_errors': 0}
+        # (url, error) of the errors of the previous crawl that are gone
+        self.resolved_errors = []
+        # Guards the link manager, workers of a parallel crawl wait on it for new links
+        self.frontier_condition = threading.Condition()
+        self._driver_multipliers = {}
+        self.pages_processed = 0
 
     def crawl_domain(self, url, max_depth=5):
-        self.domain = urlparse(url).netloc
+        self.domain = self.host(url)
         self.link_manager.add_link(url, url, depth=0)
         # While there are links to visit
-        while self.link_manager.has_more_links():
-            referrer, link, depth = self.link_manager.get_link()
+        while True:
+            if not self.link_manager.has_more_links():
+                if not self.link_manager.has_pending_links():
+                    break
+                # Another crawler sharing the frontier may still queue links
+                sleep(self.poll_interval)
+                continue
+            record = self.link_manager.get_link()
+            if record is None:
+                # Taken by another crawler sharing the frontier
+                continue
+            referrer, link, depth = record
+            self._process_frontier_link(self.driver, link, referrer, depth, max_depth)
+        self.data_manager.flush()
+        self._log_incremental_stats()
+
+    def crawl_domain_parallel(self, url, drivers=None, driver_factory=None, workers=4, max_depth=5):
+        """
+        Crawls the domain with several browsers sharing the same frontier and crawl_iteration.
+        :Args:
+         - url: The url to start from.
+         - drivers: Already initialized drivers to crawl with, they are left open.
+         - driver_factory: Callable returning a new driver, called workers times when drivers is None. Those drivers are quit at the end.
+         - workers: Number of drivers to create with driver_factory.
+         - max_depth: Links deeper than this are not processed.
+
+        :Returns:
+         - dict with the number of pages processed, the elapsed seconds, the pages per second and the pacing of every
+           host (see HostScheduler.stats).
+        """
+        owned_drivers = []
+        if drivers is None:
+            if driver_factory is None:
+                raise ValueError('Either drivers or driver_factory is needed for a parallel crawl')
+            drivers = []
+            for _ in range(workers):
+                driver = driver_factory()
+                owned_drivers.append(driver)
+                drivers.append(driver)
+        for driver in drivers:
+            if driver is not self.driver:
+                driver.execute_cdp_cmd("Network.enable", {})
+                driver.execute_cdp_cmd("Console.enable", {})
+
+        self.domain = self.host(url)
+        self.link_manager.add_link(url, url, depth=0)
+        self.pages_processed = 0
+        in_flight = [0]
+        start = time.time()
+
+        def work(driver):
+            while True:
+                with self.frontier_condition:
+                    while not self.link_manager.has_more_links() and in_flight[0] > 0:
+                        self.frontier_condition.wait()
+                    if not self.link_manager.has_more_links():
+                        if self.link_manager.has_pending_links():
+                            # Another process sharing the frontier may still queue links
+                            self.frontier_condition.wait(self.poll_interval)
+                            continue
+                        # Nothing queued and nothing being processed that could queue more
+                        self.frontier_condition.notify_all()
+                        return
+                    record = self.link_manager.get_link()
+                    if record is None:
+                        continue
+                    referrer, link, depth = record
+                    in_flight[0] += 1
+                try:
+                    self._process_frontier_link(driver, link, referrer, depth, max_depth)
+                finally:
+                    with self.frontier_condition:
+                        in_flight[0] -= 1
+                        self.frontier_condition.notify_all()
+
+        threads = [threading.Thread(target=work, args=(driver,), name=f'devtools-ai-crawler-{i}', daemon=True)
+                   for i, driver in enumerate(drivers)]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            for driver in owned_drivers:
+                try:
+                    driver.quit()
+                except Exception as e:
+                    log.debug(f'Error quitting crawler driver: {e}')
+            self.data_manager.flush()
+        self._log_incremental_stats()
+
+        elapsed = time.time() - start
+        stats = {'pages': self.pages_processed, 'seconds': elapsed,
+                 'pages_per_second': self.pages_processed / elapsed if elapsed > 0 else 0.0,
+                 'hosts': self.scheduler.stats()}
+        log.info(f"Crawled {stats['pages']} pages in {elapsed:.1f}s ({stats['pages_per_second']:.2f} pages/s) with {len(drivers)} browsers")
+        return stats
+
+    def _log_incremental_stats(self):
+        if self.fingerprints is not None:
+            log.info('Incremental crawl: {new} new, {changed} changed, {unchanged} unchanged and {not_modified} not '
+                     'modified pages, {new_errors} new and {resolved_errors} resolved errors'.format(**self.incremental_stats))
+
+    def _process_frontier_link(self, driver, link, referrer, depth, max_depth):
+        # Every link taken from the frontier ends visited or failed, else a persistent frontier would wait on it forever
+        done = False
+        try:
+            with self.frontier_condition:
+                seen = self.link_manager.seen(link)
+            if seen:
+                # Already crawled as the target of a redirect
+                log.debug(f'Skipping link {link} because it was already visited')
+            elif depth <= max_depth:
+                self.process_link(link, referrer, depth, driver=driver)
+                with self.frontier_condition:
+                    self.pages_processed += 1
+            else:
+                log.info(f'Skipping link {link} because it is too deep {depth}')
+                self._visited_link(link)
+            done = True
+        except Exception as e:
+            log.error(f"Error processing link {link}: {e}")
+        finally:
+            if not done:
+                self._failed_link(link)
+
+    def _add_link(self, referrer, link, depth):
+        with self.frontier_condition:
+            self.link_manager.add_link(referrer, link, depth)
+            self.frontier_condition.notify()
+
+    def canonicalize(self, url):
+        return self.canonicalizer(url) if self.canonicalizer else url
+
+    def host(self, url):
+        # Of the canonical url, where the host is lowercased and the default port dropped
+        return urlparse(self.canonicalize(url)).netloc
+
+    def should_load(self, url):
+        """
+        Whether url is a page of the crawled domain worth loading.
+        """
+        parsed = urlparse(url)
+        if self.host(url) != self.domain:
+            return False
+        return not (self.skip_extensions and parsed.path.lower().endswith(self.skip_extensions))
+
+    def _add_links(self, referrer, links, depth):
+        with self.frontier_condition:
+            self.link_manager.add_links(referrer, links, depth)
+            self.frontier_condition.notify_all()
+
+    def _visited_link(self, link):
+        with self.frontier_condition:
+            self.link_manager.visited_link(link)
+
+    def _failed_link(self, link):
+        with self.frontier_condition:
+            self.link_manager.failed_link(link)
+            self.frontier_condition.notify_all()
+
+    def wait_for_page_ready(self, driver):
+        """
+        Waits until the document is loaded and the requests seen in the performance log have drained, or load_timeout.
+        Returns the performance log entries read while waiting, as they are consumed from the driver.
+        """
+        entries = []
+        in_flight = set()
+        start = time.time()
+        last_activity = start
+        while True:
+            for entry in driver.get_log('performance'):
+                entries.append(entry)
+                try:
+                    message = json.loads(entry['message'])['message']
+                except Exception:
+                    continue
+                method = message.get('method', '')
+                if not method.startswith('Network.'):
+                    continue
+                last_activity = time.time()
+                request_id = message.get('params', {}).get('requestId')
+                if method == 'Network.requestWillBeSent':
+                    in_flight.add(request_id)
+                elif method == 'Network.loadingFinished' or method == 'Network.loadingFailed':
+                    in_flight.discard(request_id)
+            now = time.time()
+            if not in_flight and now - last_activity >= self.idle_time and self._document_ready(driver):
+                break
+            if now - start >= self.load_timeout:
+                log.debug(f'Page not idle after {self.load_timeout}s, {len(in_flight)} requests still in flight')
+                break
+            sleep(self.poll_interval)
+        return entries
+
+    def _document_ready(self, driver):
+        try:
+            return driver.execute_script('return document.readyState') == 'complete'
+        except Exception:
+            return True
+
+    def _get_multiplier(self, driver):
+        """
+        Screenshot pixels per CSS pixel of driver. Drivers of a parallel crawl may have another device pixel ratio than
+        the SmartDriver one, theirs is read once.
+        """
+        if driver is self.driver:
+            return self.smart_driver.multiplier
+        with self.frontier_condition:
+            multiplier = self._driver_multipliers.get(driver)
+        if multiplier is None:
             try:
-                if depth <= max_depth:
-                    self.process_link(link, referrer, depth)
-                else:
-                    log.info(f'Skipping link {link} because it is too deep {depth}')
+                multiplier = float(driver.execute_script('return window.devicePixelRatio') or 1.0)
             except Exception as e:
-                log.error(f"Error processing link {link}: {e}")
+                log.debug(f'Could not read the device pixel ratio of a crawler driver: {e}')
+                multiplier = 1.0
+            with self.frontier_condition:
+                self._driver_multipliers[driver] = multiplier
+        return multiplier
+
+    def _get_screenshot(self, driver):
+        if driver is self.driver:
+            return self.smart_driver._get_screenshot()
+        return driver.get_screenshot_as_base64()
 
-    def process_console_logs(self, console_logs, link):
+    def process_console_logs(self, console_logs, link, fingerprint=None, previous=None):
         for l in console_logs:
+            if (l['level'] == 'SEVERE' or is_js_error(l['message'])) and \
+                    not self._is_new_error(f"console:{l['message']}", fingerprint, previous):
+                continue
             if (l['level'] == 'SEVERE'):
                 log.debug(f"Bad JS: {l['message']}")
                 self.data_manager.save_console_error(crawl_iteration=self.crawl_iteration,
@@ -164,82 +891,253 @@ class Scanner:
                                                     error_details=l,
                                                     error_message=l['message'])
 
-    def process_perf_logs(self, perf_logs, link, referrer):
+    def process_perf_logs(self, perf_logs, link, referrer, driver=None, fingerprint=None, previous=None):
+        if driver is None:
+            driver = self.driver
         perf_logs = [json.loads(lr["message"])["message"] for lr in perf_logs]
         responses = [l for l in perf_logs if l["method"] == "Network.responseReceived"]
-        for r in responses:
+        if fingerprint is not None:
+            self._fingerprint_document(fingerprint, responses)
+        self._pace_host(link, responses)
+        bad_responses = [r for r in responses if r['params']['response']['status'] >= 400]
+        bad_responses = [r for r in bad_responses if self._is_new_error(
+            f"request:{r['params']['response']['status']}:{r['params']['response']['url']}", fingerprint, previous)]
+        if not bad_responses:
+            return
+
+        # Broken resources are located on the page that is already loaded: one script for every anchor and image,
+        # and at most one screenshot upload for the whole page.
+        try:
+            resources = self.collect_page_resources(driver)
+        except Exception as e:
+            log.debug(f'Could not collect the resources of {link}: {e}')
+            resources = []
+        save_id = None
+        screenshot_uploaded = False
+        for r in bad_responses:
             status = r['params']['response']['status']
-            if status >= 400:
-                log.debug(f"Bad request: {status} {r['params']['response']['url']}")
-                save_id = None
-                box = {'x': 0, 'y': 0, 'width': 0, 'height': 0}
-                used_referrer = False
-                try:
-                    try:
-                        self.driver.get(referrer)
-                        sleep(2)
-                        partial_url = r['params']['response']['url'].lstrip('http://').lstrip('https://').lstrip(self.domain)
-                        inpage_link = self.driver.find_element(By.XPATH, f"//a[contains(@href,'{partial_url}')]")
-                        used_referrer = True
-                    except NoSuchElementException as e:
-                        self.driver.get(link)
-                        sleep(2)
-                        partial_url = r['params']['response']['url'].lstrip('http://').lstrip('https://').lstrip(self.domain)
-                        inpage_link = self.driver.find_element(By.XPATH, f"//img[contains(@src,'{partial_url}')]")
-
-                    screenshot = self.smart_driver._get_screenshot()
-                    # save screenshot to file
-                    box = {'x': inpage_link.location['x'], 'y': inpage_link.location['y'],
-                           'width': inpage_link.size['width'], 'height': inpage_link.size['height']}
-                    for k in box:
-                        box[k] *= self.smart_driver.multiplier
-                    save_id = self.data_manager.upload_screenshot(self.crawl_iteration, screenshot)
-                except Exception as e:
-                    pass
-                if used_referrer:
-                    context_url = referrer
-                else:
-                    context_url = link
-                self.data_manager.save_network_error(crawl_iteration=self.crawl_iteration,
-                                                context_url=context_url,
-                                                referrer_url=referrer,
-                                                request_url=r['params']['response']['url'],
-                                                status_code=status,
-                                                error_type='request',
-                                                error_details=r,
-                                                screenshot_uuid=save_id,
-                                                element_location=box)
-
-    def process_link(self, link, referrer, depth):
-        _ = self.driver.get_log('browser')  # clear logs
-        _ = self.driver.get_log("performance")
-        self.driver.get(link)
-        sleep(2.0)
+            request_url = r['params']['response']['url']
+            log.debug(f"Bad request: {status} {request_url}")
+            box = {'x': 0, 'y': 0, 'width': 0, 'height': 0}
+            screenshot_uuid = None
+            if request_url == link or self.canonicalize(request_url) == self.canonicalize(link):
+                # The page itself is broken, the faulty link lives on the referrer
+                context_url = referrer
+            else:
+                context_url = link
+                resource = self.find_page_resource(resources, request_url)
+                if resource is not None:
+                    multiplier = self._get_multiplier(driver)
+                    box = {k: resource[k] * multiplier for k in ('x', 'y', 'width', 'height')}
+                    if not screenshot_uploaded:
+                        screenshot_uploaded = True
+                        try:
+                            save_id = self.data_manager.upload_screenshot(self.crawl_iteration, self._get_screenshot(driver))
+                        except Exception as e:
+                            log.debug(f'Could not upload the screenshot of {link}: {e}')
+                    screenshot_uuid = save_id
+            self.data_manager.save_network_error(crawl_iteration=self.crawl_iteration,
+                                            context_url=context_url,
+                                            referrer_url=referrer,
+                                            request_url=request_url,
+                                            status_code=status,
+                                            error_type='request',
+                                            error_details=r,
+                                            screenshot_uuid=screenshot_uuid,
+                                            element_location=box)
+
+    def _pace_host(self, link, responses):
+        """
+        Backs off the hosts that answered 429 / 503 while the page loaded, speeds the crawled host back up otherwise.
+        """
+        throttled = {}
+        for r in responses:
+            response = r['params']['response']
+            if response['status'] in HostScheduler.THROTTLE_STATUSES:
+                headers = {k.lower(): v for k, v in response.get('headers', {}).items()}
+                throttled.setdefault(urlparse(response['url']).netloc, (response['url'], headers.get('retry-after')))
+        for url, retry_after in throttled.values():
+            self.scheduler.throttled(url, retry_after)
+        if urlparse(link).netloc not in throttled:
+            self.scheduler.succeeded(link)
+
+    def _is_new_error(self, key, fingerprint, previous):
+        """
+        Records the error in the fingerprint of the page, and tells whether the previous crawl of the page missed it.
+        """
+        if fingerprint is not None:
+            fingerprint.errors.add(key)
+        new = previous is None or key not in previous.errors
+        if new and previous is not None:
+            with self.frontier_condition:
+                self.incremental_stats['new_errors'] += 1
+        return new
+
+    def _fingerprint_document(self, fingerprint, responses):
+        for r in responses:
+            params = r['params']
+            if params.get('type') != 'Document' or params.get('requestId') != params.get('loaderId'):
+                continue
+            headers = {k.lower(): v for k, v in params['response'].get('headers', {}).items()}
+            fingerprint.status = params['response']['status']
+            fingerprint.etag = headers.get('etag')
+            fingerprint.last_modified = headers.get('last-modified')
+            return
+
+    def _not_modified(self, link, previous):
+        """
+        Asks the server whether the page changed since the previous crawl, without downloading it.
+        """
+        headers = {}
+        if previous.etag:
+            headers['If-None-Match'] = previous.etag
+        if previous.last_modified:
+            headers['If-Modified-Since'] = previous.last_modified
+        if not headers:
+            return False
+        try:
+            with self.scheduler.slot(link), \
+                    self.data_manager.session.get(link, headers=headers, allow_redirects=False, stream=True,
+                                                  timeout=self.load_timeout) as r:
+                if r.status_code in HostScheduler.THROTTLE_STATUSES:
+                    self.scheduler.throttled(link, r.headers.get('Retry-After'))
+                return r.status_code == 304
+        except Exception as e:
+            log.debug(f'Conditional request to {link} failed: {e}')
+            return False
+
+    def _end_incremental_page(self, link, fingerprint, previous):
+        resolved = sorted(previous.errors - fingerprint.errors) if previous is not None else []
+        with self.frontier_condition:
+            if previous is None:
+                self.incremental_stats['new'] += 1
+            elif fingerprint.same_content(previous):
+                self.incremental_stats['unchanged'] += 1
+            else:
+                self.incremental_stats['changed'] += 1
+            self.incremental_stats['resolved_errors'] += len(resolved)
+            self.resolved_errors.extend((link, error) for error in resolved)
+        for error in resolved:
+            log.info(f'Resolved since the previous crawl of {link}: {error}')
+        self.fingerprints.put(fingerprint)
+
+    def collect_page_resources(self, driver):
+        """
+        Returns the absolute url, tag and rect (document coordinates) of every anchor and image of the page.
+        """
+        resources = driver.execute_script(PAGE_RESOURCES_SCRIPT) or []
+        return [{'tag': tag, 'url': url, 'x': x, 'y': y, 'width': width, 'height': height}
+                for tag, url, x, y, width, height in resources]
+
+    def collect_page_links(self, driver):
+        """
+        Returns the absolute href of every anchor followed by the src of every image, in a single round trip.
+        """
+        return driver.execute_script(PAGE_LINKS_SCRIPT) or []
+
+    def find_page_resource(self, resources, request_url):
+        """
+        Finds the element loading or linking to request_url, images first, exact urls before partial ones.
+        """
+        parsed = urlparse(request_url)
+        partial_url = parsed.path + ('?' + parsed.query if parsed.query else '')
+        for exact in (True, False):
+            for tag in ('img', 'a'):
+                for resource in resources:
+                    if resource['tag'] != tag or not resource['url']:
+                        continue
+                    if exact and resource['url'] == request_url:
+                        return resource
+                    if not exact and partial_url and partial_url != '/' and partial_url in resource['url']:
+                        return resource
+        return None
+
+    def process_link(self, link, referrer, depth, driver=None):
+        if driver is None:
+            driver = self.driver
+        fingerprint = previous = None
+        if self.fingerprints is not None:
+            previous = self.fingerprints.get(self.canonicalize(link))
+            fingerprint = PageFingerprint(self.canonicalize(link))
+            if previous is not None and self.conditional_requests and self._not_modified(link, previous):
+                log.info(f'Not modified since the previous crawl {link}')
+                with self.frontier_condition:
+                    self.incremental_stats['not_modified'] += 1
+                self._add_links(link, [url for url in previous.links if self.should_load(url)], depth + 1)
+                self.fingerprints.put(previous)
+                self._visited_link(link)
+                return
+        _ = driver.get_log('browser')  # clear logs
+        _ = driver.get_log("performance")
+        with self.scheduler.slot(link):
+            driver.get(link)
+            perf_logs = self.wait_for_page_ready(driver)
         log.info(f"Processing link {link}")
-        console_logs = self.driver.get_log("browser")
-        self.process_console_logs(console_logs, link)
+        console_logs = driver.get_log("browser")
+        self.process_console_logs(console_logs, link, fingerprint=fingerprint, previous=previous)
 
-        perf_logs = self.driver.get_log("performance")
-        self.process_perf_logs(perf_logs, link, referrer)
+        perf_logs += driver.get_log("performance")
+        self.process_perf_logs(perf_logs, link, referrer, driver=driver, fingerprint=fingerprint, previous=previous)
 
+        self.data_manager.end_page()
         log.info(f'Visited {link}')
-        self.link_manager.visited_link(link)
         local_referrer = link
 
         for i in range(3):
             try:
-                if urlparse(link).netloc == self.domain:
-                    links = self.driver.find_elements(By.TAG_NAME, 'a')
-                    for link in links:
-                        if urlparse(link.get_attribute('href')).netloc == self.domain:
-                            self.link_manager.add_link(local_referrer, link.get_attribute('href'), depth + 1)
-
-                    imgs = self.driver.find_elements(By.TAG_NAME, 'img')
-                    for img in imgs:
-                        if urlparse(img.get_attribute('src')).netloc == self.domain:
-                            self.link_manager.add_link(local_referrer, img.get_attribute('src'), depth + 1)
+                if self.host(link) == self.domain:
+                    if not self.should_follow(driver, link, fingerprint=fingerprint):
+                        with self.frontier_condition:
+                            self.pages_skipped += 1
+                        break
+                    if fingerprint is not None and fingerprint.same_content(previous):
+                        links = previous.links
+                    else:
+                        # As found on the page, the link manager deduplicates them on their canonical url
+                        links = [url for url in dict.fromkeys(self.collect_page_links(driver)) if self.should_load(url)]
+                    if fingerprint is not None:
+                        fingerprint.links = links
+                    self._add_links(local_referrer, links, depth + 1)
                     break
             except Exception as e:
                 log.error(f"Error processing link {link}: {e}")
                 sleep(2.0)
-                continue
\ No newline at end of file
+                continue
+        if fingerprint is not None:
+            self._end_incremental_page(link, fingerprint, previous)
+        # Only once its links are queued, so crawlers sharing the frontier never see it empty in between
+        self._visited_link(local_referrer)
+
+    def should_follow(self, driver, link, fingerprint=None):
+        """
+        Whether the links of the loaded page are worth queuing: it is an HTML page of the domain, not reached through
+        a redirect to a page already crawled and, with dedupe_by_content, not a copy of a page already crawled.
+        The hash of the rendered DOM is recorded in fingerprint.
+        """
+        if not (self.skip_non_html or self.dedupe_by_content or self.canonicalizer or fingerprint is not None):
+            return True
+        content_type, location, content_hash = driver.execute_script(PAGE_INFO_SCRIPT,
+                                                                     self.dedupe_by_content or fingerprint is not None)
+        if fingerprint is not None:
+            fingerprint.dom_hash = content_hash
+        if self.skip_non_html and content_type and content_type.split(';')[0].strip().lower() not in HTML_CONTENT_TYPES:
+            log.info(f'Not following the links of {link}, it is {content_type}')
+            return False
+        if self.canonicalize(location) != self.canonicalize(link):
+            if self.host(location) != self.domain:
+                log.info(f'Not following the links of {link}, it redirects to {location}')
+                return False
+            with self.frontier_condition:
+                seen = self.link_manager.seen(location)
+                self.link_manager.visited_link(location)
+            if seen:
+                log.info(f'Not following the links of {link}, it redirects to {location} which was already crawled')
+                return False
+        if self.dedupe_by_content and content_hash:
+            with self.frontier_condition:
+                duplicate = content_hash in self.content_hashes
+                self.content_hashes.add(content_hash)
+            if duplicate:
+                log.info(f'Not following the links of {link}, its content is the same as a page already crawled')
+                return False
+        return True
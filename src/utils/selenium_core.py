@@ -1,16 +1,19 @@
 import base64
 import hashlib
+import inspect
 import json
 import logging
 import os
 import platform
 import requests
 import sys
+import threading
 import time
 import traceback
 import uuid
 import warnings
 import io
+import numpy as np
 from distutils.util import strtobool
 from PIL import Image
 from packaging import version
@@ -24,11 +27,27 @@ else:
 from selenium.webdriver.common.by import By
 
 requests.packages.urllib3.disable_warnings()
-from .scanner import Scanner
+from .scanner import DEFAULT_SKIP_EXTENSIONS, DEFAULT_STRIP_PARAMS, Scanner, URLCanonicalizer
+from .network_utils import NetworkUtils, PooledSession
+from .background import BackgroundTaskQueue
 
 
 log = logging.getLogger(__name__)
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def get_image_size(screenshot_b64):
+    """
+    Returns the (width, height) of a base64 screenshot. PNGs are measured from the IHDR chunk of their first
+    24 bytes, without decoding the rest of the image.
+    """
+    header = base64.b64decode(screenshot_b64[:32])
+    if header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+        return int.from_bytes(header[16:20], 'big'), int.from_bytes(header[20:24], 'big')
+    return Image.open(io.BytesIO(base64.b64decode(screenshot_b64))).size
+
+
 class SeleniumDriverCore(object):
     def __init__(self, driver, api_key=None, initialization_options={}):
         """
@@ -41,6 +60,7 @@ class SeleniumDriverCore(object):
         :Returns:
          - Driver - the new driver object to use for your tests
         """
+        self._init_start = time.time()
         self.driver = driver
         if api_key is None:
             if 'DEVTOOLSAI_API_KEY' in os.environ:
@@ -61,23 +81,59 @@ class SeleniumDriverCore(object):
         self.use_cdp = initialization_options.get('use_cdp', False)
         self.use_ai_elem = initialization_options.get('use_ai_elem', False)
         self.use_fast_js_chopper = initialization_options.get('use_fast_js_chopper', False)
+        self.use_vectorized_matching = initialization_options.get('vectorized_element_match', True)
         self.detect_timeout = initialization_options.get('detect_timeout', 60)
         self.misc_timeout = initialization_options.get('misc_timeout', 10)
         self.do_exact_match_first = initialization_options.get('do_exact_match_first', False)
         self.do_local_caching = initialization_options.get('local_caching', False)
         self.local_match_threshold = initialization_options.get('local_match_threshold', 0.998)
+        self.local_template_cache_mb = initialization_options.get('local_template_cache_mb', 256)
+        self.local_match_workers = initialization_options.get('local_match_workers', 1)
+        self.local_match_pyramid_scale = initialization_options.get('local_match_pyramid_scale', None)
+        self.local_match_roi_search = initialization_options.get('local_match_roi_search', False)
+        self.local_match_nms_iou = initialization_options.get('local_match_nms_iou', None)
+        self.local_match_max_candidates = initialization_options.get('local_match_max_candidates', None)
+        self.local_prefetch_workers = initialization_options.get('local_prefetch_workers', 4)
+        self.local_prefetch_timeout = initialization_options.get('local_prefetch_timeout', 60)
+        self.local_download_workers = initialization_options.get('local_download_workers', 8)
+        self.scanner_idle_time = initialization_options.get('scanner_idle_time', 0.5)
+        self.scanner_load_timeout = initialization_options.get('scanner_load_timeout', 10)
+        self.scanner_async_reporting = initialization_options.get('scanner_async_reporting', False)
+        self.scanner_frontier_path = initialization_options.get('scanner_frontier_path', None)
+        self.scanner_crawl_iteration = initialization_options.get('scanner_crawl_iteration', None)
+        self.scanner_frontier_lease_timeout = initialization_options.get('scanner_frontier_lease_timeout', 600)
+        # Set it to resume, with the same frontier path and crawl iteration, a crawl no other runner is part of
+        self.scanner_resume_in_progress = initialization_options.get('scanner_resume_in_progress', False)
+        self.scanner_canonicalize_urls = initialization_options.get('scanner_canonicalize_urls', True)
+        self.scanner_strip_query_params = initialization_options.get('scanner_strip_query_params', DEFAULT_STRIP_PARAMS)
+        self.scanner_keep_fragments = initialization_options.get('scanner_keep_fragments', False)
+        self.scanner_skip_extensions = initialization_options.get('scanner_skip_extensions', DEFAULT_SKIP_EXTENSIONS)
+        self.scanner_dedupe_by_content = initialization_options.get('scanner_dedupe_by_content', False)
+        self.scanner_fingerprint_path = initialization_options.get('scanner_fingerprint_path', None)
+        self.scanner_conditional_requests = initialization_options.get('scanner_conditional_requests', True)
+        self.scanner_max_requests_per_second = initialization_options.get('scanner_max_requests_per_second', None)
+        self.scanner_max_in_flight_per_host = initialization_options.get('scanner_max_in_flight_per_host', None)
         self.element_names_in_tc = []
         self.exact_match_first_threshold = initialization_options.get('exact_match_first_threshold', 0.999)
 
         self.url = initialization_options.get('server_url',
                 os.environ.get('DEVTOOLSAI_URL', 'https://smartdriver.dev-tools.ai'))
         self.default_prod_url = 'https://smartdriver.dev-tools.ai'
+        self.http_session = PooledSession(pool_connections=initialization_options.get('http_pool_connections', 4),
+                                          pool_maxsize=initialization_options.get('http_pool_maxsize', 10),
+                                          pool_block=initialization_options.get('http_pool_block', False))
+        self.network_utils = NetworkUtils(self.url, session=self.http_session)
+        self.upload_queue = None
+        if initialization_options.get('async_uploads', False):
+            self.upload_queue = BackgroundTaskQueue(max_size=initialization_options.get('async_upload_queue_size', 16),
+                                                    workers=initialization_options.get('async_upload_workers', 1),
+                                                    drop_policy=initialization_options.get('async_upload_drop_policy', 'block'),
+                                                    block_timeout=initialization_options.get('async_upload_block_timeout', 30),
+                                                    name='devtools-ai-upload')
+        # Created on first use by _get_scanner
         self.scanner = None
-        try:
-            if self._driver_type == 'selenium':
-                self.scanner = Scanner(self, self.driver, self.url, self.api_key)
-        except Exception:
-            pass
+        # Set by the drivers that classify locally
+        self.local_classify = None
 
 
         test_case_name = initialization_options.get('test_case_name', None)
@@ -91,13 +147,15 @@ class SeleniumDriverCore(object):
         if self.test_case_creation_mode:
             self.use_classifier_during_creation = initialization_options.get('use_classifier_during_creation', True)
 
-        self._checkin()
-        window_size = self.driver.get_window_size()
-        screenshotBase64 = self._get_screenshot()
-
-        im = Image.open(io.BytesIO(base64.b64decode(screenshotBase64)))
-        width, height = im.size
-        self.multiplier = 1.0 * width / window_size['width']
+        # The check-in runs while the screen is measured, only local classification needs its labels
+        self._checkin_done = threading.Event()
+        self._checkin_lock = threading.Lock()
+        self._checkin_callbacks = []
+        if initialization_options.get('async_checkin', True):
+            threading.Thread(target=self._run_checkin, name='devtools-ai-checkin', daemon=True).start()
+        else:
+            self._run_checkin()
+        self._measure_screen()
         # Disable warnings
         requests.packages.urllib3.disable_warnings()
         warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -105,20 +163,20 @@ class SeleniumDriverCore(object):
         self.misc_timeout_message =  'devtools_ai service timeout, probably under heavy load or slow connection, doubling the misc_timeout, you can also manually set the misc_timeout to a higher value in initialization_dict, current value: %s s'
         self.detect_timeout_message =  'devtools_ai service timeout, probably under heavy load or slow connection, doubling the detect_timeout, you can also manually set the detect_timeout to a higher value in initialization_dict, current value: %s s'
 
-        for a_name in dir(self.driver):
-            if a_name in dir(self):
-                continue
-            try:
-                def _call_driver(*args, name=a_name, **kwargs):
-                    v = getattr(self.driver, name)
-                    return v(*args, **kwargs)
-                v = getattr(self.driver, a_name)
-                if hasattr(v, '__call__'):
-                    setattr(self, a_name, _call_driver)
-                else:
-                    setattr(self, a_name, v)
-            except Exception as err:
-                continue
+    def __getattr__(self, name):
+        """
+        Delegates the attributes SmartDriver does not define to the wrapped driver, when they are first accessed.
+        Bound methods are cached on the instance, other values are read from the driver on every access so properties
+        stay fresh.
+        """
+        driver = self.__dict__.get('driver')
+        if driver is None or name.startswith('__'):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        value = getattr(driver, name)
+        if inspect.ismethod(value) and value.__self__ is driver:
+            self.__dict__[name] = value
+        return value
+
     @property
     def current_window_handle(self) -> str:
         return self.driver.current_window_handle
@@ -159,24 +217,55 @@ class SeleniumDriverCore(object):
 
     def get(self, url):
         self.driver.get(url)
-        for a_name in dir(self.driver):
-            try:
-                v = getattr(self.driver, a_name)
-                if hasattr(v, '__call__'):
-                    continue
-                elif '__' == a_name[0:2]:
-                    # Skip these as they mess with internal properties
-                    continue
-                else:
-                    setattr(self, a_name, v)
-            except Exception as err:
-                continue
 
     def implicitly_wait(self, wait_time):
         self.driver.implicitly_wait(wait_time)
 
+    def flush_uploads(self, timeout=None):
+        """
+        Waits for the queued training uploads to be sent. Returns False if the timeout expired first.
+        """
+        if self.upload_queue is None:
+            return True
+        return self.upload_queue.flush(timeout)
+
+    def quit(self):
+        if self.upload_queue is not None:
+            self.upload_queue.close()
+        if self.local_classify is not None:
+            self.local_classify.close()
+        self.driver.quit()
+
+    def _get_scanner(self):
+        # _driver_type is only known once the subclass is initialized, so the scanner is created on first use
+        if self.scanner is None:
+            self.scanner = Scanner(self, self.driver, self.url, self.api_key, idle_time=self.scanner_idle_time,
+                                   load_timeout=self.scanner_load_timeout,
+                                   async_reporting=self.scanner_async_reporting,
+                                   crawl_iteration=self.scanner_crawl_iteration,
+                                   frontier_path=self.scanner_frontier_path,
+                                   frontier_lease_timeout=self.scanner_frontier_lease_timeout,
+                                   resume_in_progress=self.scanner_resume_in_progress,
+                                   canonicalizer=self.scanner_canonicalize_urls and URLCanonicalizer(
+                                       drop_fragment=not self.scanner_keep_fragments,
+                                       strip_params=self.scanner_strip_query_params),
+                                   skip_extensions=self.scanner_skip_extensions,
+                                   dedupe_by_content=self.scanner_dedupe_by_content,
+                                   fingerprint_path=self.scanner_fingerprint_path,
+                                   conditional_requests=self.scanner_conditional_requests,
+                                   max_requests_per_second=self.scanner_max_requests_per_second,
+                                   max_in_flight_per_host=self.scanner_max_in_flight_per_host)
+        return self.scanner
+
     def scan_domain(self, domain, max_depth=10):
-        self.scanner.crawl_domain(domain, max_depth=max_depth)
+        self._get_scanner().crawl_domain(domain, max_depth=max_depth)
+
+    def scan_domain_parallel(self, domain, drivers=None, driver_factory=None, workers=4, max_depth=10):
+        """
+        Scans the domain with several browsers sharing one frontier, see Scanner.crawl_domain_parallel.
+        """
+        return self._get_scanner().crawl_domain_parallel(domain, drivers=drivers, driver_factory=driver_factory,
+                                                         workers=workers, max_depth=max_depth)
 
     def find_element(self, by='id', value=None, element_name=None):
         """
@@ -420,10 +509,13 @@ class SeleniumDriverCore(object):
                 driver_element = find_method(*args)
             if driver_element:
                 try:
-                    key = self._upload_screenshot_if_necessary(element_name, driver_element=driver_element)
-                    if key is not None:
-                        # Key is None when element is frozen or another issue during screenshot and upload.
-                        self._update_elem(driver_element, key, element_name)
+                    if self.upload_queue is not None:
+                        self._queue_training_upload(element_name, driver_element)
+                    else:
+                        key = self._upload_screenshot_if_necessary(element_name, driver_element=driver_element)
+                        if key is not None:
+                            # Key is None when element is frozen or another issue during screenshot and upload.
+                            self._update_elem(driver_element, key, element_name)
                 except Exception as e:
                     log.exception(e)
                     log.error('error uploading screenshot to Dev Tools. Continuing.')
@@ -440,6 +532,58 @@ class SeleniumDriverCore(object):
                 raise Exception(msg)
         return None
 
+    def _measure_screen(self):
+        """
+        Reads the window size and the size of one screenshot to compute the screenshot / window pixel ratio.
+        """
+        self.window_size = self.driver.get_window_size()
+        self.im_size = get_image_size(self._get_screenshot())
+        self.multiplier = 1.0 * self.im_size[0] / self.window_size['width']
+
+    def _init_done(self):
+        """
+        Records how long the construction of the SmartDriver took.
+        """
+        self.init_duration = time.time() - self._init_start
+        log.debug(f'SmartDriver initialized in {self.init_duration * 1000:.0f}ms')
+
+    def _run_checkin(self):
+        try:
+            self._checkin()
+        finally:
+            # Done only once the callbacks ran, so waiters see the prefetches they started
+            while True:
+                with self._checkin_lock:
+                    callbacks = self._checkin_callbacks
+                    self._checkin_callbacks = []
+                    if not callbacks:
+                        self._checkin_done.set()
+                        break
+                for callback in callbacks:
+                    self._call_checkin_callback(callback)
+
+    def _after_checkin(self, callback):
+        """
+        Calls callback with the labels of the test case once the check-in is done, right away if it already is.
+        """
+        with self._checkin_lock:
+            if not self._checkin_done.is_set():
+                self._checkin_callbacks.append(callback)
+                return
+        self._call_checkin_callback(callback)
+
+    def _call_checkin_callback(self, callback):
+        try:
+            callback(self.element_names_in_tc)
+        except Exception as e:
+            log.exception(e)
+
+    def _wait_for_checkin(self, timeout=None):
+        """
+        Waits for the check-in. Returns False if the timeout expired first.
+        """
+        return self._checkin_done.wait(timeout)
+
     def _checkin(self):
         """
         Check in the current session.
@@ -451,7 +595,7 @@ class SeleniumDriverCore(object):
                 'test_case_name': self.test_case_uuid,
                 'automation_name': self.automation_name}
         try:
-            res = requests.post(self.url + '/ping', json=data, timeout=10, verify=False)
+            res = self.http_session.post(self.url + '/ping', json=data, timeout=10, verify=False)
             res = res.json()
             if not res['success']:
                 log.error(res['message'])
@@ -465,64 +609,32 @@ class SeleniumDriverCore(object):
             pass
 
     def make_json_post_request(self, route, data, timeout_error_message, timeout_variable, generic_error_message=None, tries=3):
-        # Verify is False as the lets encrypt certificate raises issue on mac.
-        res = {'success': False, 'message': 'did not run'}
-        local_timeout = timeout_variable
-        if generic_error_message is None:
-            generic_error_message = 'Error making request to ' + route
-        for _ in range(tries):
-            try:
-                log.debug(f'Posting to {route}')
-                url = self.url.rstrip('/') + route
-                res = requests.post(url, json=data, verify=False, timeout=local_timeout).json()
-                break
-            except requests.exceptions.ConnectTimeout:
-                local_timeout = local_timeout * 2
-                log.debug(route)
-                try: # just in case the timeout message does not have a variable to format to too many variablas to format
-                    log.error(timeout_error_message % local_timeout)
-                    log.error(generic_error_message)
-                except Exception:
-                    log.error(timeout_error_message)
-            except requests.exceptions.ConnectionError as e:
-                if 'Connection aborted' in str(e) or 'timeout' in str(e):
-                    local_timeout = local_timeout * 2
-                    log.debug(route)
-                    try:  # just in case the timeout message does not have a variable to format to too many variablas to format
-                        log.error(timeout_error_message % local_timeout)
-                        log.error(generic_error_message)
-                    except Exception:
-                        log.error(timeout_error_message)
-                else:
-                    raise e
-            except requests.exceptions.ReadTimeout as e:
-                local_timeout = local_timeout * 2
-                log.debug(route)
-                try:  # just in case the timeout message does not have a variable to format to too many variablas to format
-                    log.error(timeout_error_message % local_timeout)
-                except Exception:
-                    log.error(timeout_error_message)
-                    log.error(generic_error_message)
-            except Exception as e:
-                log.info(f'Exception type: {type(e)} and {e}')
-                log.exception(e)
-                log.error(generic_error_message)
-        return res
+        return self.network_utils.make_json_post_request(route, data, timeout_error_message, timeout_variable,
+                                                         generic_error_message=generic_error_message, tries=tries)
+
+    def connection_stats(self):
+        """
+        Returns the counters of requests, new connections and reused connections of the driver's HTTP session.
+        """
+        return self.http_session.connection_stats()
 
-    def _update_elem(self, elem, screenshot_uuid, element_name, train_if_necessary=True):
+    def _update_elem(self, elem, screenshot_uuid, element_name, train_if_necessary=True, capture=None):
+        if capture is None:
+            capture = {'rect': elem.rect, 'page_offset': self.page_offset, 'ref_screenshot_uuid': self.ref_screenshot_uuid}
+        rect = capture['rect']
         data = {
             'screenshot_uuid': screenshot_uuid,
             'retrain': train_if_necessary,
             'api_key': self.api_key,
             'label': element_name,
-            'x': elem.rect['x'] * self.multiplier,
-            'y': elem.rect['y'] * self.multiplier,
-            'width': elem.rect['width'] * self.multiplier,
-            'height': elem.rect['height'] * self.multiplier,
+            'x': rect['x'] * self.multiplier,
+            'y': rect['y'] * self.multiplier,
+            'width': rect['width'] * self.multiplier,
+            'height': rect['height'] * self.multiplier,
             'multiplier': self.multiplier,
             'test_case_name': self.test_case_uuid,
-            'page_offset': self.page_offset * self.multiplier,
-            'ref_screenshot_uuid': self.ref_screenshot_uuid
+            'page_offset': capture['page_offset'] * self.multiplier,
+            'ref_screenshot_uuid': capture['ref_screenshot_uuid']
         }
         try:
             res = self.make_json_post_request('/add_action_info', data, self.misc_timeout_message, self.misc_timeout)
@@ -578,6 +690,27 @@ class SeleniumDriverCore(object):
         if self._check_frozen(element_name):
             return None
 
+        screenshotBase64, screenshot_uuid = self._capture_element_screenshot(driver_element)
+        return self._upload_screenshot(element_name, screenshotBase64, screenshot_uuid)
+
+    def _queue_training_upload(self, element_name, driver_element):
+        """
+        Captures the screenshot and element rect now, and leaves the frozen check, upload and action info to the upload queue.
+        """
+        screenshotBase64, screenshot_uuid = self._capture_element_screenshot(driver_element)
+        capture = {'rect': dict(driver_element.rect), 'page_offset': self.page_offset,
+                   'ref_screenshot_uuid': self.ref_screenshot_uuid}
+        if not self.upload_queue.submit(self._run_training_upload, element_name, screenshotBase64, screenshot_uuid, capture):
+            log.warning(f'Upload queue full, skipping training upload for {element_name}')
+
+    def _run_training_upload(self, element_name, screenshotBase64, screenshot_uuid, capture):
+        if self._check_frozen(element_name):
+            return
+        key = self._upload_screenshot(element_name, screenshotBase64, screenshot_uuid)
+        if key is not None:
+            self._update_elem(None, key, element_name, capture=capture)
+
+    def _capture_element_screenshot(self, driver_element=None):
         screenshotBase64 = self._get_screenshot()
         screenshot_uuid = self.get_screenshot_hash(screenshotBase64)
         self.ref_screenshot_uuid = None
@@ -593,7 +726,9 @@ class SeleniumDriverCore(object):
                 screenshot_uuid = self.get_screenshot_hash(screenshotBase64)
                 self.page_offset = self.driver.execute_script('return window.pageYOffset')
                 self._scroll_page(int(self.previous_page_offset - self.page_offset)) # scroll back to initial position
+        return screenshotBase64, screenshot_uuid
 
+    def _upload_screenshot(self, element_name, screenshotBase64, screenshot_uuid):
         # Check results
         try:
             response = self._check_screenshot_exists(screenshot_uuid, element_name)
@@ -703,6 +838,26 @@ class SeleniumDriverCore(object):
         else:
             return False
 
+    def _iou_boxes_array(self, box, rects):
+        """
+        Same as _iou_boxes, between one box and an (N, 4) array of x, y, width, height rects.
+        """
+        rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+        dx = np.minimum(box['x'] + box['width'], rects[:, 0] + rects[:, 2]) - np.maximum(box['x'], rects[:, 0])
+        dy = np.minimum(box['y'] + box['height'], rects[:, 1] + rects[:, 3]) - np.maximum(box['y'], rects[:, 1])
+        overlap = np.where((dx >= 0) & (dy >= 0), dx * dy, 0.0)
+        union = box['width'] * box['height'] + rects[:, 2] * rects[:, 3] - overlap
+        return np.divide(overlap, union, out=np.zeros_like(overlap), where=union != 0)
+
+    def _center_hit_array(self, box, rects):
+        """
+        Same as _center_hit, between one box and an (N, 4) array of x, y, width, height rects.
+        """
+        rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+        cx = box['x'] + box['width'] / 2
+        cy = box['y'] + box['height'] / 2
+        return (cx > rects[:, 0]) & (cx < rects[:, 0] + rects[:, 2]) & (cy > rects[:, 1]) & (cy < rects[:, 1] + rects[:, 3])
+
     def _send_warning(self, real_xpath, label, screenshot_uuid, resp_data, is_backup=False):
         element_box = resp_data.get('predicted_element')
         score = resp_data.get('score', None)
@@ -0,0 +1,186 @@
+import contextlib
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class TemplateStore:
+    """
+    Decoded templates stored as raw pixel arrays appended to shard files, indexed by a SQLite database (WAL mode).
+    Templates are read back as read-only NumPy views of the memory-mapped shards, without copying or decoding.
+    The database also keeps the element data, one row per element.
+    :Args:
+     - directory: Where the shards and the index live, created if needed.
+     - shard_bytes: Size above which a new shard is started.
+    """
+    ALIGNMENT = 64
+
+    def __init__(self, directory, shard_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.shard_bytes = shard_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        # Shard number to its current mapping, remapped when it grew past the mapped size
+        self._maps = {}
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.db'), timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS templates (
+                                 uuid TEXT PRIMARY KEY,
+                                 shard INTEGER NOT NULL,
+                                 offset INTEGER NOT NULL,
+                                 nbytes INTEGER NOT NULL,
+                                 shape TEXT NOT NULL,
+                                 dtype TEXT NOT NULL)""")
+        self.conn.execute('CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, size INTEGER NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS elements (name TEXT PRIMARY KEY, data TEXT NOT NULL)')
+
+    def get_shard_path(self, shard):
+        return os.path.join(self.directory, f'shard-{shard:04d}.bin')
+
+    def contains(self, template_uuid):
+        with self._lock:
+            return self.conn.execute('SELECT 1 FROM templates WHERE uuid = ?', (template_uuid,)).fetchone() is not None
+
+    def get(self, template_uuid):
+        """
+        Returns a read-only view of the template, None if it is not stored.
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT shard, offset, nbytes, shape, dtype FROM templates WHERE uuid = ?',
+                                    (template_uuid,)).fetchone()
+            if row is None:
+                return None
+            shard, offset, nbytes, shape, dtype = row
+            mapped = self._map(shard, offset + nbytes)
+        dtype = np.dtype(dtype)
+        return np.frombuffer(mapped, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset).reshape(json.loads(shape))
+
+    def put(self, template_uuid, template):
+        """
+        Appends the template to the last shard. The index only points to it once it is fully written, so readers,
+        including other processes, never see a partial template.
+        """
+        template = np.ascontiguousarray(template)
+        with self._lock, self._transaction():
+            if self.conn.execute('SELECT 1 FROM templates WHERE uuid = ?', (template_uuid,)).fetchone() is not None:
+                return
+            row = self.conn.execute('SELECT shard, size FROM shards ORDER BY shard DESC LIMIT 1').fetchone()
+            shard, size = row if row is not None else (0, 0)
+            offset = -(-size // self.ALIGNMENT) * self.ALIGNMENT
+            if size > 0 and offset + template.nbytes > self.shard_bytes:
+                shard, offset = shard + 1, 0
+            path = self.get_shard_path(shard)
+            # Bytes past the indexed size are leftovers of an interrupted write and get overwritten
+            with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+                f.seek(offset)
+                f.write(memoryview(template).cast('B'))
+            self.conn.execute('INSERT OR REPLACE INTO shards (shard, size) VALUES (?, ?)',
+                              (shard, offset + template.nbytes))
+            self.conn.execute('INSERT INTO templates (uuid, shard, offset, nbytes, shape, dtype) VALUES (?, ?, ?, ?, ?, ?)',
+                              (template_uuid, shard, offset, template.nbytes, json.dumps(template.shape),
+                               template.dtype.str))
+
+    def get_element(self, element_name):
+        with self._lock:
+            row = self.conn.execute('SELECT data FROM elements WHERE name = ?', (element_name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_elements(self, elements):
+        with self._lock, self._transaction():
+            self.conn.executemany('INSERT OR REPLACE INTO elements (name, data) VALUES (?, ?)',
+                                  [(name, json.dumps(data)) for name, data in elements.items()])
+
+    def delete_element(self, element_name):
+        with self._lock:
+            self.conn.execute('DELETE FROM elements WHERE name = ?', (element_name,))
+
+    def element_names(self):
+        with self._lock:
+            return [row[0] for row in self.conn.execute('SELECT name FROM elements')]
+
+    def stats(self):
+        with self._lock:
+            templates, template_bytes = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM templates').fetchone()
+            shards = self.conn.execute('SELECT COUNT(*) FROM shards').fetchone()[0]
+            elements = self.conn.execute('SELECT COUNT(*) FROM elements').fetchone()[0]
+        return {'templates': templates, 'bytes': template_bytes, 'shards': shards, 'elements': elements}
+
+    def close(self):
+        with self._lock:
+            # Mappings still referenced by templates stay valid until those are released
+            self._maps.clear()
+            self.conn.close()
+
+    def _map(self, shard, needed):
+        mapped = self._maps.get(shard)
+        if mapped is None or len(mapped) < needed:
+            with open(self.get_shard_path(shard), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[shard] = mapped
+        return mapped
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+
+class ElementIndex(MutableMapping):
+    """
+    Element data of a TemplateStore, looked up per element on first access instead of loaded whole at start.
+    """
+    def __init__(self, store):
+        self.store = store
+        self._elements = {}
+
+    def __getitem__(self, element_name):
+        data = self._elements.get(element_name)
+        if data is None:
+            data = self.store.get_element(element_name)
+            if data is None:
+                raise KeyError(element_name)
+            self._elements[element_name] = data
+        return data
+
+    def __setitem__(self, element_name, data):
+        self.store.put_elements({element_name: data})
+        self._elements[element_name] = data
+
+    def __delitem__(self, element_name):
+        self._elements.pop(element_name, None)
+        self.store.delete_element(element_name)
+
+    def __contains__(self, element_name):
+        try:
+            self[element_name]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.store.element_names())
+
+    def __len__(self):
+        return len(self.store.element_names())
+
+    def update_many(self, elements):
+        """
+        Stores several elements in one transaction.
+        """
+        self.store.put_elements(elements)
+        self._elements.update(elements)